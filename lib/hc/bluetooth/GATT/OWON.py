@@ -41,13 +41,31 @@ gatt_list = {
 GATT.Characteristic.register(gatt_list)
 
 
-class MeasurementBase:
+# Lookup tables for the header fields, indexed by the raw field values
+MODE_NAMES = (
+    'Volts DC', 'Volts AC', 'Amps DC', 'Amps AC', 'Ohms',
+    'Farad', 'Hz', 'Percent', 'Centigrade', 'Farenheight',
+    'Diode Volts', 'Ohms Beep', 'hFE'
+)
+# TODO - micro + utf8
+SI_SUFFIXES = ('?000', 'n', 'u', 'm', '', 'k', 'M')
+SI_ADJUST = (None, 0.000000001, 0.000001, 0.001, 1, 1000, 1000000)
+DECIMAL_ADJUST = (1, 0.1, 0.01, 0.001, 0, 0, 0, float('nan'))
+FLAG_NAMES = ('hold', 'delta', 'AutoRange', 'BatteryLow', 'Min', 'Max')
+
+
+class Header:
+    """The decoded first three bytes of a measurement packet - the mode,
+       scale and flags.  A meter mostly sends the same few headers over and
+       over, so these are decoded once and then shared (see header())
+    """
+    __slots__ = (
+        'mode', 'raw_scale1', 'raw_scale2', 'flags',
+        'hold', 'delta', 'AutoRange', 'BatteryLow', 'Min', 'Max',
+        'suffix', 'decimal', 'si', 'tail',
+    )
 
     def __init__(self, raw):
-        self.raw = raw
-        self.timestamp = None
-        self.debug = False
-
         self.mode = (raw[0] & 0xc0) >> 6 | (raw[1] & 3) << 2
         if self.mode > 12:
             raise ValueError(
@@ -69,24 +87,68 @@ class MeasurementBase:
             raise ValueError("Unknwon mode bits set in raw data")
 
         flags = raw[2]
-        self.hold       = (flags & 1) != 0
-        self.delta      = (flags & 2) != 0
-        self.AutoRange  = (flags & 4) != 0
-        self.BatteryLow = (flags & 8) != 0
-        self.Min        = (flags & 0x10) != 0
-        self.Max        = (flags & 0x20) != 0
         if (flags & 0xc0) != 0:
             raise ValueError("Unknown flags bit set in raw data")
+        self.flags = []
+        for bit, name in enumerate(FLAG_NAMES):
+            setattr(self, name, (flags & (1 << bit)) != 0)
+            if getattr(self, name):
+                self.flags.append(name)
+
+        # Everything about the value that only depends on the header
+        self.suffix = SI_SUFFIXES[self.raw_scale1]
+        self.decimal = DECIMAL_ADJUST[self.raw_scale2]
+        self.si = SI_ADJUST[self.raw_scale1]
+
+        # The end of the string form
+        tail = ''
+        if self.suffix:
+            tail += ' '+self.suffix
+        tail += ' '+MODE_NAMES[self.mode]
+        if self.flags:
+            tail += ' (' + ','.join(self.flags) + ')'
+        self.tail = tail
+
+
+_headers = {}
+
+
+def header(raw):
+    """Return the (shared) Header object for this packet
+    """
+    key = raw[0:3]
+    obj = _headers.get(key)
+    if obj is None:
+        obj = Header(key)
+        _headers[key] = obj
+    return obj
+
+
+class MeasurementBase:
+    """One reading from the meter.  Only the header lookup and the checks
+       are done up front, the value and string forms are worked out when
+       they are first asked for.
+    """
+    __slots__ = ('raw', 'timestamp', 'debug', 'header', 'raw_value', '_str')
+
+    def __init__(self, raw):
+        raw = bytes(raw)
+        self.raw = raw
+        self.timestamp = None
+        self.debug = False
+        self._str = None
+
+        self.header = header(raw)
 
         if raw[3] != 0:
             raise ValueError("Unknown byte set in raw data")
 
-        negative = (raw[5] & 0x80) != 0
         if (raw[5] & 0x40) != 0:
             raise ValueError("Unknown value bit set in raw data")
 
-        self.raw_value = GATT.TypeUint16.raw2value([raw[4], raw[5] & 0x3f])
-        if negative:
+        self.raw_value = raw[4] | (raw[5] & 0x3f) << 8
+        if raw[5] & 0x80:
+            # negative
             self.raw_value = -self.raw_value
 
         # xx xx xx xx xx 3F High bits of value
@@ -129,62 +191,64 @@ class MeasurementBase:
         # 1011 Ohm Beep
         # 1100 hFE
 
+    def copy(self):
+        """Return a new reading with the same values.  The decoded value is
+           shared by all the notify subscribers, so this should be used
+           before changing it
+        """
+        obj = MeasurementBase.__new__(MeasurementBase)
+        for name in self.__slots__:
+            setattr(obj, name, getattr(self, name))
+        return obj
+
+    # The header fields, for compatibility
+    mode = property(lambda self: self.header.mode)
+    raw_scale1 = property(lambda self: self.header.raw_scale1)
+    raw_scale2 = property(lambda self: self.header.raw_scale2)
+    hold = property(lambda self: self.header.hold)
+    delta = property(lambda self: self.header.delta)
+    AutoRange = property(lambda self: self.header.AutoRange)
+    BatteryLow = property(lambda self: self.header.BatteryLow)
+    Min = property(lambda self: self.header.Min)
+    Max = property(lambda self: self.header.Max)
+
     def __str__(self):
-        s = ''
-        s += str(self.raw_value * self.decimal_adjust())
-        suffix = self.si_suffix()
-        if suffix:
-            s += ' '+suffix
-        # do something better with the raw_value
-        # do something better with the scale
-        # s+=unit
-
-        s += ' '+self.mode_name()
-
-        flags = []
-        names = ['hold', 'delta', 'AutoRange', 'BatteryLow', 'Min', 'Max']
-        for name in names:
-            if getattr(self, name):
-                flags.append(name)
-        if flags:
-            s += ' (' + ','.join(flags) + ')'
+        if self._str is None:
+            self._str = str(self.raw_value * self.header.decimal)
+            self._str += self.header.tail
+            # do something better with the raw_value
+            # do something better with the scale
+            # s+=unit
 
         if self.debug:
-            s += " "+GATT.TypeHexDump.raw2value(self.raw)
-        return s
+            return self._str + " "+GATT.TypeHexDump.raw2value(self.raw)
+        return self._str
 
     def mode_name(self):
-        names = [
-            'Volts DC', 'Volts AC', 'Amps DC', 'Amps AC', 'Ohms',
-            'Farad', 'Hz', 'Percent', 'Centigrade', 'Farenheight',
-            'Diode Volts', 'Ohms Beep', 'hFE'
-        ]
-        return names[self.mode]
+        return MODE_NAMES[self.header.mode]
 
     def si_suffix(self):
-        # TODO - micro + utf8
-        suffixes = ['?000', 'n', 'u', 'm', '', 'k', 'M']
-        return suffixes[self.raw_scale1]
+        return self.header.suffix
 
     def si_adjust(self):
-        scale = [None, 0.000000001, 0.000001, 0.001, 1, 1000, 1000000]
-        return scale[self.raw_scale1]
+        return self.header.si
 
     def decimal_adjust(self):
-        scale = [1, 0.1, 0.01, 0.001, 0, 0, 0, float('nan')]
-        return scale[self.raw_scale2]
+        return self.header.decimal
 
     @property
     def value(self):
-        return self.raw_value * self.decimal_adjust() * self.si_adjust()
+        return self.raw_value * self.header.decimal * self.header.si
 
 
 class Device:
 
     @classmethod
-    def all(cls, bus, prop):
-        """look through the available interfaces for sensirion devices
-            Note that this is pretty yucky, but works for the moment
+    def all(cls, bus, prop, incomplete=None):
+        """look through the available interfaces for OWON meters.
+            Any devices that are missing some of the characteristics are
+            added to the incomplete list, if one is given (see
+            GATT.discover)
         """
 
         wanted = {
@@ -194,34 +258,17 @@ class Device:
             '0000fff4-0000-1000-8000-00805f9b34fb': 'measurement',
             '0000fff5-0000-1000-8000-00805f9b34fb': 'unknown5',
         }
-        devices = {}
-
-        all_gatt = prop.interface2paths('org.bluez.GattCharacteristic1')
-        for path in all_gatt:
-            object = GATT.Characteristic(bus, prop, path)
-            if object.uuid in wanted:
-                name = wanted[object.uuid]
-                device_path = object.device_path()
-                if device_path not in devices:
-                    devices[device_path] = {}
-                devices[device_path][name] = object
-
-        r = []
-        for d in devices:
-            # ensure that all the required characteristics have been found
-            chars = [
-                'unknown1str',
-                'unknown2hex',
-                'press_button',
-                'measurement',
-                'unknown5'
-            ]
-            for char_name in chars:
-                if char_name not in devices[d]:
-                    raise ValueError
-            r.append(Device(bus, prop, d, devices[d]))
-
-        return r
+        # the characteristics that the Device cannot work without
+        required = [
+            'unknown1str',
+            'unknown2hex',
+            'press_button',
+            'measurement',
+            'unknown5',
+        ]
+
+        devices = GATT.discover(bus, prop, wanted, required, incomplete)
+        return [Device(bus, prop, d, devices[d]) for d in devices]
 
     def __init__(self, bus, prop, path, char):
         self.bus = bus
@@ -241,6 +288,7 @@ class Device:
         # bucket our data with that in mind - rounding time to 1/10 of
         # a second
         now = int(time.time()*10)/10.0
+        value = value.copy()
         value.timestamp = now
 
         self.callback_regular(self, value)
@@ -248,7 +296,7 @@ class Device:
     def _setup_callbacks(self):
         if self.callback_regular is None and self.callback_download is None:
             # neither callback type is registered, remove upstream callbacks
-            self.measurement.NotifyCallback(None)
+            self.measurement.remove_notify_callback(self._handleData)
             self.callbacks_upstream = False
             return
 
@@ -256,7 +304,7 @@ class Device:
             # we have already registered
             return
 
-        self.measurement.NotifyCallback(self._handleData)
+        self.measurement.add_notify_callback(self._handleData)
         self.callbacks_upstream = True
 
     def RegularCallback(self, cb):
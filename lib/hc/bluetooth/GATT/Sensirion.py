@@ -1,10 +1,53 @@
 
 from gi.repository import GLib
+import array
+import bisect
+import collections
+import statistics
+import sys
 import time
 
 import hc.bluetooth.GATT as GATT
 
 
+class MeasurementBlock:
+    """One log download packet: the index of the first sample and a packed
+       buffer of float values for one attribute.  The per sample Measurement
+       objects are only created if someone asks for them.
+    """
+    __slots__ = ('attr', 'index', 'values')
+
+    def __init__(self, attr, index, values):
+        self.attr = attr
+        self.index = index
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, nr):
+        if nr < 0:
+            nr += len(self.values)
+        obj = Measurement()
+        setattr(obj, self.attr, self.values[nr])
+        obj.index = self.index + nr
+        return obj
+
+    def __iter__(self):
+        for nr in range(len(self.values)):
+            yield self[nr]
+
+    def as_numpy(self):
+        """Return the values as a numpy array.  Numpy is only imported here,
+           so nothing else needs it installed (or pays for loading it)
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise RuntimeError("MeasurementBlock.as_numpy() needs numpy")
+        return numpy.frombuffer(self.values, dtype=numpy.float32)
+
+
 class TypeMeasurement(object):
     @classmethod
     def raw2value(cls, attr, raw):
@@ -13,17 +56,16 @@ class TypeMeasurement(object):
             setattr(obj, attr, GATT.TypeFloat32.raw2value(raw))
             return obj
 
-        index = GATT.TypeUint32.raw2value(raw[0:4])
-        del raw[0:4]
-        r = []
-        while len(raw) > 3:
-            obj = Measurement()
-            setattr(obj, attr, GATT.TypeFloat32.raw2value(raw[0:4]))
-            obj.index = index
-            r.append(obj)
-            del raw[0:4]
-            index += 1
-        return r
+        # A download packet is a uint32 index followed by as many float32
+        # values as will fit
+        raw = bytes(raw)
+        index = GATT.TypeUint32.raw2value_from(raw)
+        count = (len(raw) - 4) // 4
+        values = array.array('f')
+        values.frombytes(raw[4:4 + count * 4])
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return MeasurementBlock(attr, index, values)
 
 
 class TypeHumidity(object):
@@ -62,18 +104,26 @@ gatt_list = {
     # Sensirion SmartGadget
     '00001235-b38d-4985-720e-0f993a68ee41': {'func': TypeHumidity,
         'desc': 'Humidity', 'category': 'normal',
+        # notifies can be log download packets, so never cache these
+        'ttl': 0,
     },
     '00002235-b38d-4985-720e-0f993a68ee41': {'func': TypeTemperature,
         'desc': 'Temperature', 'category': 'normal',
+        # notifies can be log download packets, so never cache these
+        'ttl': 0,
     },
     '0000f235-b38d-4985-720e-0f993a68ee41': {'func': TypeTimestamp64ms,
         'desc': 'set_Time', 'category': 'misc',
     },
     '0000f236-b38d-4985-720e-0f993a68ee41': {'func': TypeTimestamp64ms,
         'desc': 'log_Min_Time', 'category': 'misc',
+        # this moves on with every new sample
+        'ttl': 1,
     },
     '0000f237-b38d-4985-720e-0f993a68ee41': {'func': TypeTimestamp64ms,
         'desc': 'log_Max_Time', 'category': 'misc',
+        # this moves on with every new sample
+        'ttl': 1,
     },
     '0000f238-b38d-4985-720e-0f993a68ee41': {'func': GATT.TypeSint8,
         'desc': 'trigger_send_log', 'category': 'misc',
@@ -120,6 +170,18 @@ class Measurement:
 
         return self
 
+    def copy(self):
+        """Return a new measurement with the same values.  The decoded value
+           is shared by all the notify subscribers, so this should be used
+           before changing it
+        """
+        obj = Measurement()
+        obj.index = self.index
+        obj.timestamp = self.timestamp
+        obj.temperature = self.temperature
+        obj.humidity = self.humidity
+        return obj
+
     def __str__(self):
         """represent the temperature and humidity as a string.  If there is
            no data, then use the gnuplot "no data" string.
@@ -154,12 +216,481 @@ class Measurement:
         return 0.5
 
 
+class Summary:
+    """The running min, max, mean and last of one value - without keeping
+       all the values around
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.last = value
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def __str__(self):
+        """The min, max and last values, in the same style as Measurement
+        """
+        return ' '.join(
+            "\\N" if value is None else "{:.2f}".format(value)
+            for value in (self.min, self.max, self.last)
+        )
+
+
+class Aggregate(Measurement):
+    """A summary of several measurements.  The temperature and humidity are
+       the mean values, so this can be used anywhere a Measurement is.  The
+       timestamp is that of the first measurement.
+    """
+
+    _attrs = ('temperature', 'humidity')
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.summary = {attr: Summary() for attr in self._attrs}
+
+    def add(self, value):
+        if self.timestamp is None:
+            self.timestamp = value.timestamp
+        self.count += 1
+        for attr in self._attrs:
+            summary = self.summary[attr]
+            summary.add(getattr(value, attr))
+            setattr(self, attr, summary.mean())
+
+    def __str__(self):
+        """The mean temperature and humidity (so gnuplot scripts using the
+           first columns still work) followed by the min, max and last of
+           each
+        """
+        s = super().__str__()
+        for attr in self._attrs:
+            s += " " + str(self.summary[attr])
+        return s
+
+
+class Aggregator:
+    """Cut down the flood of once a second measurements, by summarising
+       them over a window of either a number of seconds or a number of
+       samples, and/or by dropping measurements that have not changed by at
+       least threshold since the last one passed on.
+    """
+
+    def __init__(self, seconds=None, samples=None, threshold=None):
+        if seconds is not None and samples is not None:
+            raise ValueError("window by seconds or by samples, not both")
+        self.seconds = seconds
+        self.samples = samples
+        self.threshold = threshold
+        self.current = None
+        self._window = None
+        self.last_sent = None
+        self.stats = {
+            'in': 0,
+            'out': 0,
+        }
+
+    def add(self, value):
+        """Add one measurement, returning the measurement to pass on, or
+           None if there is nothing to pass on yet
+        """
+        self.stats['in'] += 1
+
+        if self.seconds is None and self.samples is None:
+            return self._send(value)
+
+        result = None
+        if self.seconds is not None:
+            # the windows are aligned to the clock, so that the output from
+            # several devices lines up
+            window = int(value.timestamp // self.seconds)
+            if self.current is not None and window != self._window:
+                result = self._close()
+            self._window = window
+
+        if self.current is None:
+            self.current = Aggregate()
+        self.current.add(value)
+
+        if self.samples is not None and self.current.count >= self.samples:
+            result = self._close()
+
+        if result is None:
+            return None
+        return self._send(result)
+
+    def flush(self):
+        """Return whatever is in the current partial window (or None)
+        """
+        if self.current is None:
+            return None
+        result = self._close()
+        self.last_sent = result
+        self.stats['out'] += 1
+        return result
+
+    def _close(self):
+        result = self.current
+        self.current = None
+        return result
+
+    def _changed(self, value):
+        """Has this value moved far enough from the last one we sent?
+        """
+        if self.last_sent is None:
+            return True
+        for attr in Aggregate._attrs:
+            new = getattr(value, attr)
+            old = getattr(self.last_sent, attr)
+            if new is None or old is None:
+                if new is not old:
+                    return True
+            elif abs(new - old) >= self.threshold:
+                return True
+        return False
+
+    def _send(self, value):
+        if self.threshold is not None and not self._changed(value):
+            return None
+        self.last_sent = value
+        self.stats['out'] += 1
+        return value
+
+
+class History:
+    """The downloaded log for one device.
+       Samples are stored by their index, counting back from the newest
+       sample at maxtime, in parallel columns of floats with NaN for the
+       missing values.  The timestamps are not stored at all, they are
+       worked out from maxtime and the interval.
+
+       For compatibility, this also looks like a (read only) dict of
+       Measurement objects keyed by timestamp.  Those timestamps are
+       corrected by clock_error to our clock, while everything else uses
+       the device clock (as that is what the device is asked for)
+
+       The samples that are not yet complete are tracked as a sorted list
+       of ranges, which is kept up to date as values arrive - so finding
+       the holes never needs a scan of the whole history.
+    """
+
+    TEMPERATURE = 1
+    HUMIDITY = 2
+    COMPLETE = TEMPERATURE | HUMIDITY
+
+    _bits = {
+        'temperature': TEMPERATURE,
+        'humidity': HUMIDITY,
+    }
+
+    def __init__(self, maxtime, interval, clock_error=0):
+        self.maxtime = maxtime
+        self.interval = interval
+        self.clock_error = clock_error
+        self.temperature = array.array('f')
+        self.humidity = array.array('f')
+        # one byte of flags per sample, saying which values are present
+        self.present = bytearray()
+        # the incomplete samples, as ranges from start up to (but not
+        # including) end
+        self._missing_start = []
+        self._missing_end = []
+
+    def __len__(self):
+        return len(self.present)
+
+    def timestamp(self, nr):
+        return self.maxtime - self.interval * nr
+
+    def index_of(self, timestamp):
+        """Return the sample number for the given timestamp
+        """
+        return int(round((self.maxtime - timestamp) / self.interval))
+
+    def local_timestamp(self, nr):
+        """The timestamp of a sample, by our clock
+        """
+        return self.timestamp(nr) - self.clock_error
+
+    def extend(self, size):
+        """Ensure that the store has room for at least size samples
+        """
+        grow = size - len(self.present)
+        if grow <= 0:
+            return
+        old = len(self.present)
+        missing = array.array('f', [float('nan')]) * grow
+        self.temperature.extend(missing)
+        self.humidity.extend(missing)
+        self.present.extend(bytes(grow))
+
+        if self._missing_end and self._missing_end[-1] == old:
+            self._missing_end[-1] = size
+        else:
+            self._missing_start.append(old)
+            self._missing_end.append(size)
+
+    def prepend(self, count):
+        """Make room for count newer samples in front of the existing ones
+        """
+        missing = array.array('f', [float('nan')]) * count
+        self.temperature = missing + self.temperature
+        self.humidity = missing + self.humidity
+        self.present = bytearray(count) + self.present
+        self.maxtime += self.interval * count
+
+        starts = [start + count for start in self._missing_start]
+        ends = [end + count for end in self._missing_end]
+        if starts and starts[0] == count:
+            starts[0] = 0
+        else:
+            starts.insert(0, 0)
+            ends.insert(0, count)
+        self._missing_start = starts
+        self._missing_end = ends
+
+    def _fill(self, nr):
+        """Remove a newly completed sample from the missing ranges
+        """
+        starts = self._missing_start
+        ends = self._missing_end
+        i = bisect.bisect_right(starts, nr) - 1
+        start = starts[i]
+        end = ends[i]
+
+        if start == nr and end == nr + 1:
+            del starts[i]
+            del ends[i]
+        elif start == nr:
+            # the common case, as the device sends the samples in order
+            starts[i] = nr + 1
+        elif end == nr + 1:
+            ends[i] = nr
+        else:
+            ends[i] = nr
+            starts.insert(i + 1, nr + 1)
+            ends.insert(i + 1, end)
+
+    def set(self, nr, attr, value):
+        """Store one value, returning how much more complete the history
+           has become (in the same units as Measurement.complete())
+        """
+        bit = self._bits[attr]
+        column = getattr(self, attr)
+        if self.present[nr] & bit:
+            if column[nr] != value:
+                raise ValueError
+            return 0
+        column[nr] = value
+        self.present[nr] |= bit
+        if self.present[nr] == self.COMPLETE:
+            self._fill(nr)
+        return 0.5
+
+    def missing(self, merge_gap=0):
+        """Return the list of (start, end) ranges of incomplete samples.
+           Ranges separated by merge_gap or fewer good samples are joined
+           together, as it is cheaper to fetch a few samples twice than to
+           start another download pass.
+        """
+        result = []
+        for start, end in zip(self._missing_start, self._missing_end):
+            if result and start - result[-1][1] <= merge_gap:
+                result[-1] = (result[-1][0], end)
+            else:
+                result.append((start, end))
+        return result
+
+    def missing_count(self):
+        """How many samples are not yet complete
+        """
+        return sum(self._missing_end) - sum(self._missing_start)
+
+    def missing_between(self, start, end):
+        """Is any sample from start up to (but not including) end missing?
+        """
+        i = bisect.bisect_right(self._missing_end, start)
+        return i < len(self._missing_start) and self._missing_start[i] < end
+
+    def complete_until(self):
+        """Return the timestamp of the newest sample that has no holes
+           anywhere before it.  If nothing is missing, this is the maxtime.
+           If the oldest sample is missing, this is the timestamp just before
+           the history starts.
+        """
+        if not self._missing_end:
+            return self.maxtime
+        return self.timestamp(self._missing_end[-1])
+
+    def complete(self, nr):
+        """How complete is this sample? (see Measurement.complete())
+        """
+        flags = self.present[nr]
+        if flags == self.COMPLETE:
+            return 1
+        if flags:
+            return 0.5
+        return 0
+
+    def measurement(self, nr):
+        """Build a Measurement object for one sample
+        """
+        obj = Measurement()
+        obj.index = nr + 1
+        obj.timestamp = self.local_timestamp(nr)
+        flags = self.present[nr]
+        if flags & self.TEMPERATURE:
+            obj.temperature = self.temperature[nr]
+        if flags & self.HUMIDITY:
+            obj.humidity = self.humidity[nr]
+        return obj
+
+    # The dict compatible view
+
+    def keys(self):
+        return [self.local_timestamp(nr) for nr in range(len(self.present))]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _local_index(self, timestamp):
+        nr = self.index_of(timestamp + self.clock_error)
+        if 0 <= nr < len(self.present):
+            if self.local_timestamp(nr) == timestamp:
+                return nr
+        return None
+
+    def __contains__(self, timestamp):
+        return self._local_index(timestamp) is not None
+
+    def __getitem__(self, timestamp):
+        nr = self._local_index(timestamp)
+        if nr is None:
+            raise KeyError(timestamp)
+        return self.measurement(nr)
+
+    def values(self):
+        return [self.measurement(nr) for nr in range(len(self.present))]
+
+    def items(self):
+        return [(self.local_timestamp(nr), self.measurement(nr))
+                for nr in range(len(self.present))]
+
+
+class TimebaseCalibrator:
+    """Work out how far the device clock is from ours.
+
+       The device only tells us its time indirectly - the maxtime is the
+       timestamp of the newest logged sample, so it steps up once every
+       interval.  By reading it often and noting when it steps, we can see
+       what our clock said when the device clock reached that timestamp.
+       Each read is timestamped at the midpoint of its round trip, so the
+       round trip latency (and how often we poll) limits the accuracy.
+
+       The median of the last few steps is the clock error: how far ahead
+       of us the device is.  If the device clock was set with offset, and
+       settime() cut off the fraction cut when it truncated the time, then
+       offset + error + cut is the offset that should have been used.  The
+       cut is different every time, so it has to be taken out of the fit
+       (the error after the next settime() is then just minus its cut).
+    """
+
+    # Found by hand with test_sensirion_timebase, used until a device has
+    # been calibrated
+    default_offset = 0.42
+
+    def __init__(self, samples=5):
+        self.samples = samples
+        self.rtt = collections.deque(maxlen=samples * 4)
+        self.errors = collections.deque(maxlen=samples)
+        # (maxtime, midpoint) from the previous read
+        self._prev = None
+
+    def observe(self, t0, t1, maxtime):
+        """Record one read of maxtime, that was started at t0 and answered
+           at t1.  Returns True if this gave a new clock error measurement
+        """
+        self.rtt.append(t1 - t0)
+        mid = (t0 + t1) / 2
+        prev = self._prev
+        self._prev = (maxtime, mid)
+
+        if prev is None or maxtime is None or prev[0] is None:
+            return False
+        if maxtime < prev[0]:
+            # the device clock has been set, start again
+            self.errors.clear()
+            return False
+        if maxtime == prev[0]:
+            return False
+
+        # The step happened somewhere between the two reads
+        step = (prev[1] + mid) / 2
+        self.errors.append(maxtime - step)
+        return True
+
+    def done(self):
+        return len(self.errors) >= self.samples
+
+    def latency(self):
+        """The median one way latency for a read
+        """
+        if not self.rtt:
+            return None
+        return statistics.median(self.rtt) / 2
+
+    def error(self):
+        """How far the device clock is ahead of ours (None if unknown)
+        """
+        if not self.errors:
+            return None
+        return statistics.median(self.errors)
+
+    def spread(self):
+        """How much the individual measurements disagree with each other
+        """
+        if len(self.errors) < 2:
+            return None
+        error = self.error()
+        return statistics.median(abs(e - error) for e in self.errors)
+
+    def fit(self, offset, cut=0):
+        """Given the offset that the device clock was set with and the
+           fraction of a second that was cut off the time, return the
+           offset that would have made the error zero (apart from the cut)
+        """
+        error = self.error()
+        if error is None:
+            return offset
+        return offset + error + cut
+
+
 class Device:
 
     @classmethod
-    def all(cls, bus, prop):
-        """look through the available interfaces for sensirion devices
-            Note that this is pretty yucky, but works for the moment
+    def all(cls, bus, prop, incomplete=None):
+        """look through the available interfaces for sensirion devices.
+            Any devices that are missing some of the characteristics are
+            added to the incomplete list, if one is given (see
+            GATT.discover)
         """
 
         wanted = {
@@ -172,49 +703,50 @@ class Device:
             '0000f239-b38d-4985-720e-0f993a68ee41': 'interval',
             '00002a19-0000-1000-8000-00805f9b34fb': 'battery',
         }
-        devices = {}
-
-        all_gatt = prop.interface2paths('org.bluez.GattCharacteristic1')
-        for path in all_gatt:
-            object = GATT.Characteristic(bus, prop, path)
-            if object.uuid in wanted:
-                name = wanted[object.uuid]
-                device_path = object.device_path()
-                if device_path not in devices:
-                    devices[device_path] = {}
-                devices[device_path][name] = object
-
-        r = []
-        for d in devices:
-            # ensure that all the required characteristics have been found
-            chars = [
-                'humidity',
-                'temperature',
-                'mintime',
-                'maxtime',
-                'sendlog',
-                'interval'
-            ]
-            for char_name in chars:
-                if char_name not in devices[d]:
-                    raise ValueError
-            r.append(Device(bus, prop, d, devices[d]))
-
-        return r
+        # the characteristics that the Device cannot work without
+        required = [
+            'humidity',
+            'temperature',
+            'settime',
+            'mintime',
+            'maxtime',
+            'sendlog',
+            'interval',
+        ]
+
+        devices = GATT.discover(bus, prop, wanted, required, incomplete)
+        return [Device(bus, prop, d, devices[d]) for d in devices]
 
     def __init__(self, bus, prop, path, char):
         self.bus = bus
         self.prop = prop
         self.path = path
+        self.address = prop.Get(path, 'org.bluez.Device1', 'Address')
 
         self.callback_regular = None
         self.callback_download = None
         self.callback_download_progress = None
+        self.progress_latency = False
         self.callbacks_upstream = False
         self.callbacks_self = False
 
         self.prev_value = None
-        self._history = {}
+        self.aggregator = None
+
+        # Set fast_write to send the clock and download window writes
+        # without waiting for a response (over an AcquireWrite() socket if
+        # possible), for the characteristics that allow that
+        self.fast_write = False
+
+        # What we subtract from our clock when setting the device clock,
+        # and how far ahead of us we think the device clock is
+        self.time_offset = TimebaseCalibrator.default_offset
+        self.clock_error = 0
+        # the fraction of a second that the last settime() truncated (None
+        # if it was not set by us)
+        self.settime_cut = None
+        self._history = None
+        self._offset = 0
         self._mintime = None
         self._maxtime = None
         self._total = None
@@ -222,6 +754,27 @@ class Device:
         self._count = 0
         self._passnr = 0
         self._index = 0
+        self._pass_received = 0
+        self._pass_new = 0
+        # a dict of counters for each finished download pass
+        self.pass_stats = []
+
+        # How long (in seconds) the download can be quiet before we give up
+        # on any more data arriving, and how often to report progress
+        self.download_idle = 0.5
+        self.progress_interval = 1
+        self._timer = None
+        self._download_start = None
+        # After a pass finishes early (see _pass_complete) the device may
+        # still be sending the rest of it.  Those packets cannot be told
+        # apart from the next pass, so we wait for them to stop before
+        # starting another one.
+        self._draining = False
+        self._go_pending = False
+        self._last_packet = None
+        self._last_progress = 0
+        # the highest index seen in each of the two streams
+        self._stream_end = {}
 
         self._settime_char = char['settime']
         del char['settime']
@@ -229,6 +782,15 @@ class Device:
         for char_name in char:
             setattr(self, char_name, char[char_name])
 
+    def _write(self, char, value):
+        """Write to one of the clock characteristics, see fast_write
+        """
+        if self.fast_write and char.can_write_without_response():
+            # this only does anything the first time
+            char.AcquireWrite()
+            return char.write(value, without_response=True)
+        return char.write(value)
+
     # Ideally, settime would return success/fail of trying to write to
     # the dev - the bluez interface does that by raising exceptions
     def settime(self, now=None):
@@ -237,16 +799,22 @@ class Device:
             # but it also appears to store the data history with only
             # 1s resolution.  So we use the int() here.
             # Additionally, there appears to be a latency or rounding error, so
-            # we subtract the magic number as well (see test_sensirion_timebase
-            # for testing on this)
-            now = time.time()
-            now = int(now-0.42)
+            # we subtract the time_offset as well (see TimebaseCalibrator and
+            # test_sensirion_timebase for measuring this)
+            target = time.time() - self.time_offset
+            now = int(target)
+            # if the offset is right, the device is now in step with us,
+            # apart from the part of a second that we cut off
+            self.settime_cut = target - now
+            self.clock_error = -self.settime_cut
+        else:
+            self.settime_cut = None
 
         # since the min and max will change again after setting the time,
         # invalidate the cache
         self.mintime.cache_invalidate()
         self.maxtime.cache_invalidate()
-        self._settime_char.write(now)
+        self._write(self._settime_char, now)
         return now
 
     def _handleDataRegular(self, characteristic, value):
@@ -254,6 +822,8 @@ class Device:
         # bucket our data with that in mind - round time to 1/10 of
         # a second
         now = int(time.time()*10)/10.0
+        # our own copy, as we are about to change it
+        value = value.copy()
         value.timestamp = now
 
         if self.prev_value is None:
@@ -264,58 +834,169 @@ class Device:
             self.prev_value += value
         else:
             # this is a new time period, flush the old data
-            self.callback_regular(self, self.prev_value)
+            self._sendRegular(self.prev_value)
             self.prev_value = value
 
+    def _sendRegular(self, value):
+        if self.aggregator is not None:
+            value = self.aggregator.add(value)
+            if value is None:
+                return
+        self.callback_regular(self, value)
+
     def _handleDataDownload(self, characteristic, values):
-        now = time.time()
-        self._download_timeout = now + 1
+        if self._draining:
+            # the rest of a pass that has already finished
+            self._last_packet = time.monotonic()
+            self.pass_stats[-1]['late'] += 1
+            return
+
+        if self._download_start is None:
+            # stragglers from a pass that has already finished - we cannot
+            # tell where they belong any more
+            return
+
+        now = time.monotonic()
+        self._last_packet = now
+
+        # The device indexes from 1 at the maxtime for this pass, which may
+        # not be the maxtime that the history is based on
+        history = self._history
+        nr = values.index - 1 + self._offset
+        history.extend(nr + len(values))
 
         count_add = 0
-        for value in values:
-            timestamp = self._maxtime - self._interval * (value.index - 1)
-            value.timestamp = timestamp
-            if timestamp not in self._history:
-                self._history[timestamp] = value
-                count_add += value.complete()
-            else:
-                old_complete = self._history[timestamp].complete()
-                self._history[timestamp] += value
-                new_complete = self._history[timestamp].complete()
-                count_add += new_complete - old_complete
+        attr = values.attr
+        for value in values.values:
+            count_add += history.set(nr, attr, value)
+            nr += 1
 
         self._count += count_add
-        self._index = values[0].index
+        self._pass_received += len(values) * 0.5
+        self._pass_new += count_add
+        self._index = values.index
 
-    def _DownloadTimeout(self):
-        if self._download_timeout is None:
-            # download has not started, do nothing
-            return True
+        end = values.index + len(values) - 1
+        if end > self._stream_end.get(attr, 0):
+            self._stream_end[attr] = end
+
+        if self._pass_complete():
+            self._DownloadFinish(drain=not self._streams_ended())
+            return
 
         if self.callback_download_progress is not None:
-            # send a progress report
-            self.callback_download_progress(
-                self,
-                self._index,
-                self._passnr,
-                self._count,
-                self._total,
-            )
+            if now - self._last_progress >= self.progress_interval:
+                self._last_progress = now
+                self._progress()
 
-        now = time.time()
-        if now < self._download_timeout:
-            # timeout time has not arrived, do nothing
+    def _pass_complete(self):
+        """Can we tell from the data that this pass is finished?
+        """
+        # Every sample in the window for this pass has arrived
+        last = self._passtotal + 1
+        if not self._history.missing_between(self._offset, self._offset + last):
             return True
 
+        # Or both streams have sent their last index, so anything still
+        # missing is not going to turn up this time
+        return self._streams_ended()
+
+    def _streams_ended(self):
+        """Have both streams sent the last index of this pass?
+        """
+        last = self._passtotal + 1
+        for attr in History._bits:
+            if self._stream_end.get(attr, 0) < last:
+                return False
+        return True
+
+    def _progress(self, latency=None):
+        args = (self, self._index, self._passnr, self._count, self._total)
+        if not self.progress_latency:
+            self.callback_download_progress(*args)
+            return
+        self.callback_download_progress(*args, latency=latency)
+
+    def _arm_timer(self, delay):
+        """Start the one timer for this device, unless it is already running
+        """
+        if self._timer is None:
+            ms = max(1, int(delay * 1000))
+            self._timer = GLib.timeout_add(ms, self._DownloadTimeout)
+
+    def _DownloadTimeout(self):
+        self._timer = None
+        if self._draining:
+            idle = time.monotonic() - self._last_packet
+            if idle < self.download_idle:
+                self._arm_timer(self.download_idle - idle)
+                return False
+            # the last pass has gone quiet, so it is safe to start another
+            self._draining = False
+            if self._go_pending:
+                self._go_pending = False
+                self._DownloadStart()
+            return False
+
+        if self._download_start is None:
+            # the pass has already finished
+            return False
+
+        if self._last_packet is None:
+            # download has not started, keep waiting
+            self._arm_timer(self.download_idle)
+            return False
+
+        idle = time.monotonic() - self._last_packet
+        if idle < self.download_idle:
+            # there has been data since the timer was set, so check again
+            # when the idle time would be up
+            self._arm_timer(self.download_idle - idle)
+            return False
+
         # if we get here, the download has started, but not progressed
         # recently
+        self._DownloadFinish()
+        return False
+
+    def _DownloadFinish(self, drain=False):
+        """This pass is over, tidy up and tell the callback.  If drain is
+           set, the device is probably still sending the rest of the pass
+        """
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+
+        now = time.monotonic()
+        # How long after the last packet did we notice that we were done
+        latency = None
+        if self._last_packet is not None:
+            latency = now - self._last_packet
+
+        self.pass_stats.append({
+            'passnr': self._passnr,
+            'requested': self._passtotal + 1,
+            'received': self._pass_received,
+            'new': self._pass_new,
+            'missing': self._history.missing_count(),
+            'duration': now - self._download_start,
+            'latency': latency,
+            'late': 0,
+        })
+        self._download_start = None
+
+        if drain:
+            self._draining = True
+            self._arm_timer(self.download_idle)
+
+        if self.callback_download_progress is not None:
+            self._progress(latency=latency)
 
         self.callback_download(self, self._history)
-        return False
 
     def _handleData(self, characteristic, values):
         # single item values time-based regular notifies (and not downloads)
-        if type(values) != type(list()):
+        if not isinstance(values, MeasurementBlock):
             return self._handleDataRegular(characteristic, values)
 
         # this must be a download
@@ -324,8 +1005,8 @@ class Device:
     def _setup_callbacks(self):
         if self.callback_regular is None and self.callback_download is None:
             # neither callback type is registered, remove upstream callbacks
-            self.humidity.NotifyCallback(None)
-            self.temperature.NotifyCallback(None)
+            self.humidity.remove_notify_callback(self._handleData)
+            self.temperature.remove_notify_callback(self._handleData)
             self.callbacks_upstream = False
             return
 
@@ -333,15 +1014,53 @@ class Device:
             # we have already registered
             return
 
-        self.humidity.NotifyCallback(self._handleData)
-        self.temperature.NotifyCallback(self._handleData)
+        self.humidity.add_notify_callback(self._handleData)
+        self.temperature.add_notify_callback(self._handleData)
         self.callbacks_upstream = True
 
+    def _start_notify(self):
+        """Ask the device to start sending notifies, once
+        """
+        def runonce(func, *args):
+            """A wrapper for the GLib.timeout_add that just runs once
+            """
+            func(*args)
+            return False
+
+        if not self.callbacks_self:
+            # The notifies are reference counted, so this is safe even if
+            # something else is already listening for periodic data
+            GLib.timeout_add_seconds(0, runonce, self.humidity.StartNotify)
+            GLib.timeout_add_seconds(0, runonce, self.temperature.StartNotify)
+            self.callbacks_self = True
+
     def RegularCallback(self, cb):
-        """Register a callback for regular per-second updates
+        """Register a callback for regular per-second updates.  This also
+           starts the notifies, so it works without a download
         """
         self.callback_regular = cb
         self._setup_callbacks()
+        if cb is not None:
+            self._start_notify()
+
+    def RegularAggregate(self, seconds=None, samples=None, threshold=None):
+        """Summarise the regular updates before they are sent to the
+           callback (see Aggregator).  With no args, turn this off again
+        """
+        if seconds is None and samples is None and threshold is None:
+            self.aggregator = None
+            return
+        self.aggregator = Aggregator(seconds, samples, threshold)
+
+    def RegularFlush(self):
+        """Send any partly summarised regular updates on to the callback
+           now, instead of waiting for the window to end
+        """
+        if self.aggregator is None or self.callback_regular is None:
+            return
+        value = self.aggregator.flush()
+        if value is not None:
+            self.callback_regular(self, value)
 
     def DownloadCallback(self, cb):
         """Register a callback for download data
@@ -349,10 +1068,15 @@ class Device:
         self.callback_download = cb
         self._setup_callbacks()
 
-    def DownloadProgressCallback(self, cb):
-        """Register a callback getting status on the download in progress
+    def DownloadProgressCallback(self, cb, latency=False):
+        """Register a callback getting status on the download in progress,
+           called as cb(device, index, passnr, count, total).  If latency
+           is set, it also gets a latency= keyword arg, which is only
+           given (as the seconds since the last packet) on the last call
+           for each pass
         """
         self.callback_download_progress = cb
+        self.progress_latency = latency
 
     def DownloadSetup(self, min=None, max=None):
         """Fetch all the values and do all the calculations for a download
@@ -369,7 +1093,7 @@ class Device:
             self._maxtime = self.maxtime.cache_read()
         else:
             max = int(max)
-            self.maxtime.write(max)
+            self._write(self.maxtime, max)
             self._maxtime = max
 
         if self._maxtime is None:
@@ -378,16 +1102,17 @@ class Device:
 
         self._interval = self.interval.cache_read()
 
+        # I've never successfully recieved the earliest datapoint, so I
+        # assume that they have an off-by-one issue somewhere.  Any min
+        # we are given is treated the same way, so it should be the
+        # timestamp of the sample just before the ones we want
         if min is None:
             self._mintime = self.mintime.cache_read()
-
-            # I've never successfully recieved the earliest datapoint, so I
-            # assume that they have an off-by-one issue somewhere
-            self._mintime += self._interval
         else:
             min = int(min)
-            self.mintime.write(min)
+            self._write(self.mintime, min)
             self._mintime = min
+        self._mintime += self._interval
 
         self._timespan = self._maxtime - self._mintime
         self._passtotal = int(self._timespan / self._interval)
@@ -396,38 +1121,92 @@ class Device:
             # _passtotal is how many measurements we want to download this time
             self._total = self._passtotal
         self._passnr += 1
-        self._download_timeout = None
+        self._pass_received = 0
+        self._pass_new = 0
 
         # ensure that all expected history points exist (allowing for much
         # simple checking for missing points
-        timestamp = self._maxtime
-        while timestamp >= self._mintime:
-            if timestamp not in self._history:
-                entry = Measurement()
-                entry.timestamp = timestamp
-                self._history[timestamp] = entry
-            timestamp -= self._interval
+        if self._history is None or self._history.interval != self._interval:
+            self._history = History(
+                self._maxtime,
+                self._interval,
+                self.clock_error,
+            )
+        elif self._maxtime > self._history.maxtime:
+            self._history.prepend(
+                self._history.index_of(self._maxtime) * -1)
+        self._offset = self._history.index_of(self._maxtime)
+        self._history.extend(self._history.index_of(self._mintime) + 1)
 
-        def runonce(func, *args):
-            """A wrapper for the GLib.timeout_add that just runs once
-            """
-            func(*args)
-            return False
+        self._start_notify()
+        return True
 
-        if not self.callbacks_self:
-            # FIXME - we could be already notifying on these from something
-            # that is listening for periodic data..
-            GLib.timeout_add_seconds(0, runonce, self.humidity.StartNotify)
-            GLib.timeout_add_seconds(0, runonce, self.temperature.StartNotify)
-            self.callbacks_self = True
+    def missing_windows(self, merge_gap=0):
+        """Return a list of (mintime, maxtime) windows that still need to be
+           downloaded, cheapest first.  These are suitable for passing
+           to DownloadSetup() for the next pass.
+        """
+        history = self._history
+        if history is None:
+            return []
+
+        windows = sorted(
+            (end - start, start, end)
+            for start, end in history.missing(merge_gap)
+        )
+
+        # The mintime is the sample just before the ones we want (see
+        # DownloadSetup)
+        return [
+            (history.timestamp(end), history.timestamp(start))
+            for cost, start, end in windows
+        ]
+
+    def calibrate(self, calibrator):
+        """Use the results from a TimebaseCalibrator that has been watching
+           this device since it was last set with our time_offset.  If we
+           did not set the clock, only the clock_error can be updated
+        """
+        error = calibrator.error()
+        if error is None:
+            return
+        if self.settime_cut is not None:
+            self.time_offset = calibrator.fit(
+                self.time_offset,
+                self.settime_cut,
+            )
+        self.clock_error = error
 
-        # FIXME - dont add this twice either..
-        GLib.timeout_add_seconds(1, self._DownloadTimeout)
-        return True
+    def clock_drift(self, now=None):
+        """Estimate how far the device clock is from ours, in seconds.
+           The newest sample in the log should be less than one interval
+           old, so anything outside that window is drift (to within the
+           resolution of the interval).
+        """
+        if now is None:
+            now = time.time()
+        maxtime = self.maxtime.cache_read()
+        interval = self.interval.cache_read()
+        if maxtime is None or interval is None:
+            return None
+
+        age = now - maxtime
+        if age < 0:
+            return age
+        if age > interval:
+            return age - interval
+        return 0
 
     def DownloadGo(self):
         """Actually start the download
         """
+        if self._draining:
+            # wait for the last pass to go quiet (see _DownloadTimeout)
+            self._go_pending = True
+            return
+        self._DownloadStart()
+
+    def _DownloadStart(self):
 
         def runonce(func, *args):
             """A wrapper for the GLib.timeout_add that just runs once
@@ -435,4 +1214,10 @@ class Device:
             func(*args)
             return False
 
+        self._download_start = time.monotonic()
+        self._last_packet = None
+        self._last_progress = 0
+        self._stream_end = {}
+        self._arm_timer(self.download_idle)
+
         GLib.timeout_add_seconds(0, runonce, self.sendlog.write, 1)
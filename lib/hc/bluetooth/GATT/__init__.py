@@ -1,72 +1,67 @@
 
+import collections
+import importlib
+import os
 import struct
+import time
+import traceback
+import weakref
 import dbus
 
+import hc.stats
 
-class TypeSint8(object):
-    @classmethod
-    def raw2value(cls, raw):
-        return struct.unpack('b', bytearray(raw))[0]
-
-    @classmethod
-    def value2raw(cls, value):
-        return struct.pack('b', value)
 
+class TypeStruct(object):
+    """Common code for all the types that are a single struct field
+    """
+    _struct = None
 
-class TypeUint8(object):
     @classmethod
     def raw2value(cls, raw):
-        return struct.unpack('B', bytearray(raw))[0]
+        # Note that bytes() does not copy an existing bytes object, so this
+        # only costs anything for a dbus.Array.  Use unpack() and not
+        # unpack_from(), so that the whole value must be the right size
+        return cls._struct.unpack(bytes(raw))[0]
+
+    @classmethod
+    def raw2value_from(cls, buf, offset=0):
+        """Decode the value at the given offset within a larger buffer
+        """
+        return cls._struct.unpack_from(buf, offset)[0]
 
     @classmethod
     def value2raw(cls, value):
-        return struct.pack('B', value)
+        return cls._struct.pack(value)
 
 
-class TypeUint16(object):
-    @classmethod
-    def raw2value(cls, raw):
-        return struct.unpack('<H', bytearray(raw))[0]
+class TypeSint8(TypeStruct):
+    _struct = struct.Struct('b')
 
-    @classmethod
-    def value2raw(cls, value):
-        return struct.pack('<H', value)
 
+class TypeUint8(TypeStruct):
+    _struct = struct.Struct('B')
 
-class TypeUint32(object):
-    @classmethod
-    def raw2value(cls, raw):
-        return struct.unpack('<I', bytearray(raw))[0]
 
-    @classmethod
-    def value2raw(cls, value):
-        return struct.pack('<I', value)
+class TypeUint16(TypeStruct):
+    _struct = struct.Struct('<H')
 
 
-class TypeFloat32(object):
-    @classmethod
-    def raw2value(cls, raw):
-        return struct.unpack('<f', bytearray(raw))[0]
+class TypeUint32(TypeStruct):
+    _struct = struct.Struct('<I')
 
-    @classmethod
-    def value2raw(cls, value):
-        return struct.pack('<f', value)
 
+class TypeFloat32(TypeStruct):
+    _struct = struct.Struct('<f')
 
-class TypeUint64(object):
-    @classmethod
-    def raw2value(cls, raw):
-        return struct.unpack('<Q', bytearray(raw))[0]
 
-    @classmethod
-    def value2raw(cls, value):
-        return struct.pack('<Q', value)
+class TypeUint64(TypeStruct):
+    _struct = struct.Struct('<Q')
 
 
 class TypeUtf8s(object):
     @classmethod
     def raw2value(cls, raw):
-        return bytearray(raw).decode('utf8')
+        return bytes(raw).decode('utf8')
 
     @classmethod
     def value2raw(cls, value):
@@ -76,23 +71,21 @@ class TypeUtf8s(object):
 class TypeHexDigits(object):
     @classmethod
     def raw2value(cls, raw):
-        s = ''
-        for ch in raw[::-1]:
-            s += format(ch, '02x')
-        return s
+        return bytes(raw)[::-1].hex()
+
+
+# Map every byte to itself if it is printable, or to a space if not
+_printable = bytes(ch if 0x20 <= ch < 0x7e else 0x20 for ch in range(256))
 
 
 class TypeHexDump(object):
     @classmethod
     def raw2value(cls, raw):
-        s = ''
+        raw = bytes(raw)
+        s = raw.translate(_printable).decode('ascii')
         h = ''
-        for ch in raw:
-            if ch in range(0x20, 0x7e):
-                s += chr(ch)
-            else:
-                s += ' '
-            h += format(ch, '02x') + ','
+        if raw:
+            h = raw.hex(',') + ','
         return h+' '+s
 
 
@@ -135,16 +128,114 @@ class TypeHumidity(object):
 
 
 class TypePnP_ID(object):
+    _struct = struct.Struct('<BHHH')
+
     @classmethod
     def raw2value(cls, raw):
-        source = TypeUint8.raw2value(raw[0])
-        vendor_id = TypeUint16.raw2value(raw[1:3])
-        product_id = TypeUint16.raw2value(raw[3:5])
-        version = TypeUint16.raw2value(raw[5:7])
-        return (source, vendor_id, product_id, version)
+        # (source, vendor_id, product_id, version)
+        return cls._struct.unpack_from(bytes(raw))
+
+
+# The Bluetooth SIG base UUID, with the first 8 hex digits removed
+SIG_BASE = '-0000-1000-8000-00805f9b34fb'
+
+
+class Registry:
+    """The known GATT characteristic types.
+       Entries are indexed by their full 128-bit UUID and, for ones built
+       on the Bluetooth SIG base UUID, by their 16-bit short form.
+
+       Vendor modules can be registered as plugins for a vendor base UUID
+       (or for some short forms on the SIG base) and are only imported when
+       a matching UUID is looked up.
+    """
+
+    def __init__(self):
+        self.by_uuid = {}
+        self.by_short = {}
+        self.plugin_by_base = {}
+        self.plugin_by_short = {}
+        self.loaded = set()
+
+    @staticmethod
+    def _split(uuid):
+        """Return the vendor base and the 16-bit short form of a UUID
+           (the short form is None unless the UUID looks like one)
+        """
+        base = uuid[8:]
+        short = None
+        if uuid.startswith('0000'):
+            short = int(uuid[4:8], 16)
+        return base, short
+
+    def update(self, entries):
+        for uuid, entry in entries.items():
+            uuid = uuid.lower()
+            self.by_uuid[uuid] = entry
+            base, short = self._split(uuid)
+            if base == SIG_BASE and short is not None:
+                self.by_short[short] = entry
+
+    def add_plugin(self, module, base=None, shorts=()):
+        """Register a module that knows about the given vendor base UUID
+           and/or the given short forms on the SIG base
+        """
+        if base is not None:
+            self.plugin_by_base[base.lower()] = module
+        for short in shorts:
+            self.plugin_by_short[short] = module
+
+    def _plugin(self, uuid):
+        """Find the module that should know about this uuid
+        """
+        base, short = self._split(uuid)
+        if base == SIG_BASE:
+            return self.plugin_by_short.get(short)
+        return self.plugin_by_base.get(base)
+
+    def lookup(self, uuid):
+        """Return the entry for the given UUID, or None if it is unknown
+        """
+        uuid = uuid.lower()
+        entry = self.by_uuid.get(uuid)
+        if entry is not None:
+            return entry
+
+        module = self._plugin(uuid)
+        if module is None or module in self.loaded:
+            return None
+
+        # importing the module will register its entries with us
+        self.loaded.add(module)
+        importlib.import_module(module)
+        return self.by_uuid.get(uuid)
+
+    def lookup_short(self, short):
+        """Return the entry for a 16-bit SIG short form UUID
+        """
+        return self.by_short.get(short)
+
+    def get(self, uuid, default=None):
+        entry = self.lookup(uuid)
+        if entry is None:
+            return default
+        return entry
+
+    def __contains__(self, uuid):
+        return self.lookup(uuid) is not None
 
+    def __getitem__(self, uuid):
+        entry = self.lookup(uuid)
+        if entry is None:
+            raise KeyError(uuid)
+        return entry
 
-gatt_list = {
+    def __len__(self):
+        return len(self.by_uuid)
+
+
+gatt_list = Registry()
+gatt_list.update({
     # Standard things
     '00002a00-0000-1000-8000-00805f9b34fb': {'func': TypeUtf8s,
         'desc': 'device_name', 'category': 'string',
@@ -195,31 +286,152 @@ gatt_list = {
     '00002a50-0000-1000-8000-00805f9b34fb': {'func': TypePnP_ID,
         'desc': 'PnP_ID', 'category': 'string',
     },
+})
+
+# The vendor specific modules, loaded only when needed
+gatt_list.add_plugin(
+    'hc.bluetooth.GATT.Sensirion',
+    base='-b38d-4985-720e-0f993a68ee41',
+)
+gatt_list.add_plugin(
+    'hc.bluetooth.GATT.OWON',
+    shorts=range(0xfff0, 0xfff6),
+)
+
+
+# How many seconds a cached value stays valid for, by category.  A ttl of
+# None means that the value is cached until invalidated, and 0 means that
+# it is never cached.  Any entry in the gatt_list can override this with a
+# 'ttl' of its own, and categories not listed here get the 'unknown' ttl.
+cache_ttl = {
+    'string': None,
+    'strings': None,
+    'id': None,
+    'misc': None,
+    'normal': 300,
+    'unknown': 300,
 }
 
 
+class ValueCache:
+    """A size bounded cache of characteristic values, where each value can
+       expire after its own time to live
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()    # key -> (expires, value)
+        self.stats = {
+            'hit': 0,
+            'miss': 0,
+            'expired': 0,
+            'evicted': 0,
+        }
+
+    def get(self, key):
+        """Return the cached value, or None if there is no valid value
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.stats['miss'] += 1
+            return None
+
+        expires, value = entry
+        if expires is not None and time.monotonic() >= expires:
+            del self.entries[key]
+            self.stats['expired'] += 1
+            self.stats['miss'] += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.stats['hit'] += 1
+        return value
+
+    def put(self, key, value, ttl):
+        if value is None or ttl == 0:
+            return
+
+        expires = None
+        if ttl is not None:
+            expires = time.monotonic() + ttl
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+
 class Characteristic:
     """Representing a GATT characteristic
     """
 
+    # Shared by all the characteristics, so that the size limit applies to
+    # the whole process
+    value_cache = ValueCache()
+
     @classmethod
     def register(cls, list):
         """Register new GATT characteristic types
         """
         gatt_list.update(list)
 
+    # There should only be one instance for any path, so we keep a
+    # dictionary of them all and return refs to existing objects if found
+    _instances = weakref.WeakValueDictionary()
+
+    def __new__(cls, bus, prop, path):
+        self = cls._instances.get((bus, path))
+        if self is None:
+            self = super().__new__(cls)
+        return self
+
+    @classmethod
+    def _evict(cls, prop, path):
+        """Forget about an object that bluez has removed
+        """
+        cls._instances.pop((prop.bus, path), None)
+        cls.value_cache.invalidate((prop.bus, path))
+
     def __init__(self, bus, prop, path):
-        # FIXME - there should only be one instance for any path, we should
-        # keep a class dictionary and return refs to existing objects
-        # if found
+        if (bus, path) in self._instances:
+            # this is an existing object, it has already been setup
+            return
 
-        self.cache = None
         self.signal = None
-        self.callback = None
+        self.callbacks = []
+        self._notify_count = 0
+
+        # Set fast_notify to use AcquireNotify and read the notifies
+        # directly from a socket, instead of as dbus signals
+        self.fast_notify = False
+        self._notify_fd = None
+        self._notify_watch = None
+        self.mtu = None
+
+        # Set dedup to drop any notify that has exactly the same raw bytes
+        # as the previous one, before spending any time decoding it
+        self.dedup = False
+        self._last_raw = None
+
+        # Used after AcquireWrite() for writes over a socket
+        self._write_fd = None
+        self.write_mtu = None
+        # set once AcquireWrite() has failed, so we do not keep asking
+        self._write_unavailable = False
+        self._write_queue = []
+        self._write_idle = None
 
         self.path = path
         self.prop = prop
 
+        # The value cache is shared by everything, so the key needs the bus
+        # as well, just like the instances
+        self._cache_key = (bus, path)
+
         self.proxy = bus.get_object('org.bluez', path)
         self.char = dbus.Interface(self.proxy,
                               dbus_interface="org.bluez.GattCharacteristic1")
@@ -231,8 +443,9 @@ class Characteristic:
             'UUID'
         )
 
-        if self.uuid in gatt_list:
-            self.entry = gatt_list[self.uuid]
+        entry = gatt_list.lookup(self.uuid)
+        if entry is not None:
+            self.entry = entry
             self.known = True
         else:
             self.entry = {
@@ -244,60 +457,387 @@ class Characteristic:
 
         self.desc = self.entry['desc']
         self.category = self.entry['category']
+        self.ttl = self.entry.get(
+            'ttl',
+            cache_ttl.get(self.category, cache_ttl['unknown'])
+        )
         self.exception = None
 
+        self.stats = {
+            'read': hc.stats.Histogram(),
+            'write': hc.stats.Histogram(),
+            'decode': hc.stats.Histogram(),
+            'notify': hc.stats.Rate(),
+            'dedup': 0,
+            'exception': 0,
+        }
+
+        self._instances[(bus, path)] = self
+        if Characteristic._evict not in prop.removed_callbacks:
+            prop.removed_callbacks.append(Characteristic._evict)
+
     def raw2value(self, raw):
         """Given the raw read results, convert it to a meaningful object
         """
-        return self.entry['func'].raw2value(raw)
+        start = time.perf_counter()
+        value = self.entry['func'].raw2value(raw)
+        self.stats['decode'].add(time.perf_counter() - start)
+        return value
 
     def value2raw(self, value):
         """Convert the meaningful value into a raw object bytestring
         """
         return self.entry['func'].value2raw(value)
 
+    def stats_snapshot(self):
+        """Return a copy of the performance counters for this
+           characteristic
+        """
+        return {
+            'path': self.path,
+            'desc': self.desc,
+            'read': self.stats['read'].snapshot(),
+            'write': self.stats['write'].snapshot(),
+            'decode': self.stats['decode'].snapshot(),
+            'notify': self.stats['notify'].snapshot(),
+            'dedup': self.stats['dedup'],
+            'exception': self.stats['exception'],
+        }
+
+    @classmethod
+    def all_stats(cls):
+        """Return the stats_snapshot() for every live characteristic
+        """
+        return [char.stats_snapshot() for char in list(cls._instances.values())]
+
+    def _exception(self, e):
+        """Remember (and count) a failure
+        """
+        self.exception = e
+        self.stats['exception'] += 1
+
 #
 # TODO - why am I messing around with catching the exceptions here?
 
     def read(self):
         self.exception = None
+        start = time.perf_counter()
         try:
             raw = self.char.ReadValue({'none': 0})
         except dbus.exceptions.DBusException as e:
-            self.prop.invalidate()
-            self.exception = e
+            self.prop.invalidate(self.device_path())
+            self._exception(e)
             return None
+        self.stats['read'].add(time.perf_counter() - start)
         return self.raw2value(raw)
 
-    def write(self, value):
+    def read_async(self, callback):
+        """Start a read without waiting for the result.  When it finishes,
+           the callback is called with this characteristic, the value and
+           the exception (one of which will be None)
+        """
+        start = time.perf_counter()
+
+        def reply(raw):
+            self.stats['read'].add(time.perf_counter() - start)
+            try:
+                value = self.raw2value(raw)
+            except Exception as e:
+                # anything escaping from here would be lost in the dbus
+                # reply handling, and the callback never called
+                self._exception(e)
+                callback(self, None, e)
+                return
+            callback(self, value, None)
+
+        def error(e):
+            self.prop.invalidate(self.device_path())
+            self._exception(e)
+            callback(self, None, e)
+
+        try:
+            self.char.ReadValue(
+                {'none': 0},
+                reply_handler=reply,
+                error_handler=error,
+            )
+        except dbus.exceptions.DBusException as e:
+            error(e)
+
+    def adapter_path(self):
+        """Find the bluetooth adapter that this characteristic is reached by
+        """
+        return self.prop.Get(
+            self.device_path(),
+            'org.bluez.Device1',
+            'Adapter'
+        )
+
+    def write(self, value, without_response=False):
+        """Write a new value.  If without_response is set, the device will
+           not acknowledge the write - and if we have a socket from
+           AcquireWrite() it will be used.
+        """
         self.cache_invalidate()
         self.exception = None
         try:
             raw = self.value2raw(value)
-            result = self.char.WriteValue(raw, {'none': 0})
+            if without_response and self._socket_fits(raw):
+                result = self._write_socket(raw)
+                if result is not None:
+                    return result
+                # the socket is gone, try again with a method call
+                self.exception = None
+            options = {'none': 0}
+            if without_response:
+                options = {'type': 'command'}
+            start = time.perf_counter()
+            result = self.char.WriteValue(raw, options)
         except dbus.exceptions.DBusException as e:
-            self.prop.invalidate()
-            self.exception = e
+            self.prop.invalidate(self.device_path())
+            self._exception(e)
             return None
+        self.stats['write'].add(time.perf_counter() - start)
         return result
 
+    def AcquireWrite(self):
+        """Get a socket to use for writes without response, saving the
+           method call for each write.  Returns the MTU that was negotiated
+           with the device, or None if this is not possible
+        """
+        if self._write_fd is not None:
+            return self.write_mtu
+        if self._write_unavailable:
+            return None
+        self.exception = None
+        try:
+            fd, mtu = self.char.AcquireWrite({})
+        except dbus.exceptions.DBusException as e:
+            self._write_unavailable = True
+            self._exception(e)
+            return None
+        self._write_fd = fd.take()
+        self.write_mtu = int(mtu)
+        return self.write_mtu
+
+    def can_write_without_response(self):
+        """Does the device allow writes without response to this?
+        """
+        flags = self.prop.Get(
+            self.path,
+            'org.bluez.GattCharacteristic1',
+            'Flags'
+        )
+        return flags is not None and 'write-without-response' in flags
+
+    def ReleaseWrite(self):
+        """Finish with the AcquireWrite() socket
+        """
+        self.write_flush()
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def _socket_fits(self, raw):
+        """Can this value be sent over the AcquireWrite() socket?
+        """
+        return self._write_fd is not None and len(raw) <= self.write_mtu
+
+    def _write_socket(self, raw):
+        start = time.perf_counter()
+        try:
+            os.write(self._write_fd, raw)
+        except OSError as e:
+            # probably disconnected, the socket is no use anymore
+            os.close(self._write_fd)
+            self._write_fd = None
+            self.prop.invalidate(self.device_path())
+            self._exception(e)
+            return None
+        self.stats['write'].add(time.perf_counter() - start)
+        return True
+
+    def write_queue(self, value):
+        """Queue a value to be written without response.  All the writes
+           queued before the main loop next goes idle are sent together.
+        """
+        from gi.repository import GLib
+
+        self.cache_invalidate()
+        self._write_queue.append(self.value2raw(value))
+        if self._write_idle is None:
+            self._write_idle = GLib.idle_add(self._write_idle_flush)
+
+    def _write_idle_flush(self):
+        self._write_idle = None
+        self.write_flush()
+        return False
+
+    def write_flush(self):
+        """Send all the queued writes now
+        """
+        queue = self._write_queue
+        self._write_queue = []
+        if not queue:
+            return
+
+        # Send as many as we can over the socket.  If one does not fit or
+        # the socket fails, it and everything after it (to keep them in
+        # order) fall back to the method calls
+        sent = 0
+        for raw in queue:
+            if not self._socket_fits(raw) or self._write_socket(raw) is None:
+                break
+            sent += 1
+        queue = queue[sent:]
+        if not queue:
+            return
+
+        # Start all the method calls without waiting for each one to
+        # return, so they can be pipelined
+        def reply(*args):
+            pass
+
+        def error(e):
+            self.prop.invalidate(self.device_path())
+            self._exception(e)
+
+        for raw in queue:
+            self.char.WriteValue(
+                raw,
+                {'type': 'command'},
+                reply_handler=reply,
+                error_handler=error,
+            )
+
     def cache_invalidate(self):
-        self.cache = None
+        self.value_cache.invalidate(self._cache_key)
 
     def cache_read(self):
-        if self.cache is None:
-            self.cache = self.read()
-        return self.cache
+        value = self.value_cache.get(self._cache_key)
+        if value is None:
+            value = self.read()
+            self.value_cache.put(self._cache_key, value, self.ttl)
+        return value
 
     def StartNotify(self):
-        return self.char.StartNotify()
+        """Ask the device to start sending notifies.  This is reference
+           counted, so each user should call it once and call StopNotify()
+           once when they are finished
+        """
+        self._notify_count += 1
+        if self._notify_count > 1:
+            # someone else has already started them
+            return None
+
+        # a new stream, so the first value is always news
+        self._last_raw = None
+
+        if self.fast_notify:
+            try:
+                return self.AcquireNotify()
+            except dbus.exceptions.DBusException:
+                # not supported by this bluez or characteristic, so just
+                # fall back to the signals
+                pass
+
+        try:
+            return self.char.StartNotify()
+        except dbus.exceptions.DBusException:
+            self._notify_count -= 1
+            raise
 
     def StopNotify(self):
+        """Drop one reference to the notifies, stopping them when there are
+           no more users
+        """
+        if not self._notify_count:
+            return None
+        self._notify_count -= 1
+        if self._notify_count:
+            return None
+
+        if self._notify_fd is not None:
+            # closing the socket is how we tell bluez that we are done
+            self._detach_notify_fd()
+            return None
         return self.char.StopNotify()
 
+    def AcquireNotify(self):
+        """Start notifies, recieving them on a socket instead of as signals
+        """
+        fd, mtu = self.char.AcquireNotify({})
+        self._attach_notify_fd(fd.take(), mtu)
+
+    def _attach_notify_fd(self, fd, mtu):
+        """Start watching the given socket for notify packets
+           (Anything that behaves like the bluez socket will do - for
+           example, one end of a socketpair)
+        """
+        from gi.repository import GLib
+
+        os.set_blocking(fd, False)
+        self._notify_fd = fd
+        self.mtu = int(mtu)
+        self._notify_watch = GLib.io_add_watch(
+            fd,
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self._handleNotifyFd,
+        )
+
+    def _detach_notify_fd(self):
+        from gi.repository import GLib
+
+        if self._notify_watch is not None:
+            GLib.source_remove(self._notify_watch)
+            self._notify_watch = None
+        os.close(self._notify_fd)
+        self._notify_fd = None
+
+    def _handleNotifyFd(self, fd, condition):
+        # read everything that is waiting, each read is one packet
+        while True:
+            try:
+                raw = os.read(fd, self.mtu)
+            except BlockingIOError:
+                break
+            except OSError:
+                raw = b''
+            if not raw:
+                # the other end has gone away
+                self._watch_lost()
+                return False
+            try:
+                self._dispatch(raw)
+            except Exception as e:
+                # An exception escaping from here would remove the watch
+                # and the notifies would silently stop.  Report it the way
+                # dbus does for the signal handlers, and carry on
+                self._exception(e)
+                traceback.print_exc()
+
+        from gi.repository import GLib
+        if condition & (GLib.IO_HUP | GLib.IO_ERR):
+            self._watch_lost()
+            return False
+        return True
+
+    def _watch_lost(self):
+        """Our notify socket was closed, probably the device disconnected
+        """
+        # returning False from the watch callback removes it for us
+        self._notify_watch = None
+        self._detach_notify_fd()
+        self._notify_count = 0
+
     def device_path(self):
         """Follow the pointers in the objects to find the parent device
         """
+        device_path = self.prop.characteristic2device(self.path)
+        if device_path is not None:
+            return device_path
+
         service_path = self.prop.Get(
             self.path,
             'org.bluez.GattCharacteristic1',
@@ -310,35 +850,253 @@ class Characteristic:
         )
         return device_path
 
-    def NotifyCallback(self, callback):
-        """Set a callback function that will recieve new values
+    def _handlePropertiesChanged(self, interface, changed, invalidated):
+        if interface != 'org.bluez.GattCharacteristic1':
+            # will this ever happen?
+            raise ValueError
+        if 'Value' not in changed:
+            # it will call us with "Notifying=True" (and probably false)
+            return
+        self._dispatch(changed['Value'])
+
+    def _dispatch(self, raw):
+        """Decode a new value and send it to all the subscribers
         """
-        if callback is None:
+        self.stats['notify'].add()
+
+        if self.dedup:
+            raw = bytes(raw)
+            if raw == self._last_raw:
+                self.stats['dedup'] += 1
+                return
+            self._last_raw = raw
+
+        # decode just once, all the subscribers share the same value
+        values = self.raw2value(raw)
+        self.value_cache.put(self._cache_key, values, self.ttl)
+        for callback in list(self.callbacks):
+            callback(self, values)
+
+    def add_notify_callback(self, callback):
+        """Add a callback function that will recieve new values.
+           Any number of callbacks can be added and they will all be called
+           with the same decoded value, so they should not change it (the
+           vendor values have a copy() method for that).
+        """
+        if callback in self.callbacks:
+            return
+        self.callbacks.append(callback)
+
+        if self.signal is None:
+            self.signal = self.proxy.connect_to_signal(
+                'PropertiesChanged',
+                self._handlePropertiesChanged
+            )
+
+    def remove_notify_callback(self, callback):
+        """Remove a callback added with add_notify_callback()
+        """
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+        if not self.callbacks and self.signal is not None:
             # clear out our junk
             self.signal.remove()
             self.signal = None
-            self.callback = None
-            # self.StopNotify()
+
+    def NotifyCallback(self, callback):
+        """Add a callback function that will recieve new values, or remove
+           all the callbacks if it is None
+        """
+        if callback is None:
+            for callback in list(self.callbacks):
+                self.remove_notify_callback(callback)
             return
 
-        if self.signal is not None:
-            raise ValueError
-        if self.callback is not None:
-            raise ValueError
+        self.add_notify_callback(callback)
 
-        def wrapper(*args, **kwargs):
-            if args[0] != 'org.bluez.GattCharacteristic1':
-                # will this ever happen?
-                raise ValueError
-            if 'Value' not in args[1]:
-                # it will call us with "Notifying=True" (and probably false)
-                return
-            values = self.raw2value(args[1]['Value'])
-            self.callback(self, values)
 
+class ReadMany:
+    """Read a batch of characteristics concurrently.
+       Reads to different devices are run in parallel, limited to
+       per_adapter at once for any one adapter and per_device at once for
+       any one device.  This needs a running main loop.
+
+       When all the reads are finished, the callback is called with a list
+       of (characteristic, value, exception) tuples, in the same order as
+       the characteristics were given.
+    """
+
+    def __init__(self, characteristics, callback, per_adapter=4,
+                 per_device=1):
         self.callback = callback
-        self.signal = self.proxy.connect_to_signal(
-            'PropertiesChanged',
-            wrapper
-        )
-        # self.StartNotify()
+        self.per_adapter = per_adapter
+        self.per_device = per_device
+
+        self.results = [None] * len(characteristics)
+        self.remaining = len(characteristics)
+
+        # queue up the work for each device
+        self._queue = collections.OrderedDict()
+        self._adapter = {}
+        for nr, char in enumerate(characteristics):
+            device = char.device_path()
+            if device not in self._queue:
+                self._queue[device] = collections.deque()
+                self._adapter[device] = char.adapter_path()
+            self._queue[device].append((nr, char))
+
+        self._busy_device = collections.Counter()
+        self._busy_adapter = collections.Counter()
+        self._pumping = False
+        self._again = False
+
+    def start(self):
+        if not self.remaining:
+            self.callback(self.results)
+            return
+        self._pump()
+
+    def _pump(self):
+        """Start as many reads as the limits allow
+        """
+        if self._pumping:
+            # A read finished (probably failed) straight away, from within
+            # our own loop below.  Rather than recursing, which a long run
+            # of failures could take past the recursion limit, just tell
+            # the loop to go around again.
+            self._again = True
+            return
+
+        self._pumping = True
+        self._again = True
+        while self._again:
+            self._again = False
+            for device, queue in list(self._queue.items()):
+                adapter = self._adapter[device]
+                while queue and \
+                        self._busy_device[device] < self.per_device and \
+                        self._busy_adapter[adapter] < self.per_adapter:
+                    nr, char = queue.popleft()
+                    self._busy_device[device] += 1
+                    self._busy_adapter[adapter] += 1
+                    self._start_one(nr, char, device, adapter)
+                if not queue:
+                    self._queue.pop(device, None)
+        self._pumping = False
+
+    def _start_one(self, nr, char, device, adapter):
+        def done(char, value, exception):
+            self.results[nr] = (char, value, exception)
+            self._busy_device[device] -= 1
+            self._busy_adapter[adapter] -= 1
+            self.remaining -= 1
+            if not self.remaining:
+                self.callback(self.results)
+                return
+            self._pump()
+
+        char.read_async(done)
+
+
+def read_many(characteristics, callback, per_adapter=4, per_device=1):
+    """Start reading all the given characteristics concurrently, see
+       ReadMany for the details
+    """
+    reader = ReadMany(characteristics, callback, per_adapter, per_device)
+    reader.start()
+    return reader
+
+
+def discover(bus, prop, wanted, required=(), incomplete=None):
+    """Find the devices that have the characteristics we want, where
+       wanted is a dict of UUID to name.  The candidate devices are found
+       from the required UUIDs, and the rest are then looked up for just
+       those devices.  Characteristic objects are only made for the
+       devices that are returned - the searching is all done with the
+       cached object tree.
+
+       Returns a dict of device path to a dict of name to Characteristic.
+       Devices that are missing any of the required names are left out,
+       and if incomplete is a list, (device path, missing names) is
+       appended to it for each of them.  Devices with none of the required
+       names (eg, they just have a common battery level) are not
+       interesting at all, so they are not reported.
+    """
+    # Only a device with at least one of the required characteristics is
+    # worth looking at (or with any wanted one, if nothing is required)
+    uuids = wanted
+    if required:
+        by_name = {name: uuid for uuid, name in wanted.items()}
+        uuids = [by_name[name] for name in required if name in by_name]
+
+    candidates = set()
+    for uuid in uuids:
+        for path in prop.uuid2paths(uuid):
+            device_path = prop.characteristic2device(path)
+            if device_path is None:
+                # the service has not turned up yet
+                continue
+            candidates.add(device_path)
+
+    found = {}
+    for device_path in sorted(candidates):
+        paths = {}
+        for uuid, name in wanted.items():
+            matches = prop.uuid2paths(uuid, device_path)
+            if matches:
+                paths[name] = max(matches)
+
+        missing = [name for name in required if name not in paths]
+        if missing:
+            if incomplete is not None:
+                incomplete.append((device_path, missing))
+            continue
+        found[device_path] = {
+            name: Characteristic(bus, prop, path)
+            for name, path in paths.items()
+        }
+    return found
+
+
+def print_stats(prop, file=None):
+    """Print a summary of the performance counters, as comments suitable for
+       mixing with the normal output
+    """
+    cache = prop.stats_snapshot()
+    hit_rate = cache['hit_rate']
+    if hit_rate is not None:
+        hit_rate = "{:.1f}%".format(hit_rate * 100)
+    print("# cache: fetch={} avoided={} path_refresh={} hit_rate={} "
+          "block_max={}".format(
+              cache['fetch'],
+              cache['fetch_avoided'],
+              cache['path_refresh'],
+              hit_rate,
+              hc.stats.format_seconds(cache['block_max']),
+          ), file=file)
+
+    values = Characteristic.value_cache.stats
+    print("# value cache: hit={} miss={} expired={} evicted={}".format(
+        values['hit'], values['miss'], values['expired'], values['evicted'],
+    ), file=file)
+
+    for char in sorted(Characteristic.all_stats(), key=lambda x: x['path']):
+        print("# {} {}".format(char['path'], char['desc']), file=file)
+        for name in ('read', 'write', 'decode'):
+            if char[name]['count']:
+                print("#   {:<6} {}".format(
+                    name,
+                    hc.stats.format_histogram(char[name]),
+                ), file=file)
+        notify = char['notify']
+        if notify['count']:
+            rate = notify['per_second']
+            if rate is not None:
+                rate = "{:.1f}/s".format(rate)
+            print("#   notify n={} rate={}".format(notify['count'], rate),
+                  file=file)
+        if char['dedup']:
+            print("#   dedup dropped={}".format(char['dedup']), file=file)
+        if char['exception']:
+            print("#   exceptions={}".format(char['exception']), file=file)
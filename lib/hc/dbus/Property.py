@@ -1,41 +1,490 @@
-
 import dbus
+import time
+
+
+class FrozenDict(dict):
+    """A dict that cannot be changed after it has been built (and can thus
+       be hashed)
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('FrozenDict cannot be modified')
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+
+def native(value):
+    """Convert a value received from dbus into plain python types
+    """
+    # Note that the order matters, as most of the dbus types are
+    # subclasses of the python types
+    if isinstance(value, dbus.Boolean):
+        return bool(value)
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    if isinstance(value, dbus.Array) and value.signature == 'y':
+        return bytes(value)
+    if isinstance(value, dict):
+        return FrozenDict((native(k), native(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(native(v) for v in value)
+    return value
+
+
+# The properties used by the Cache indexes, for each interface
+_indexed = {
+    'org.bluez.GattService1': frozenset(['Device']),
+    'org.bluez.GattCharacteristic1': frozenset(['UUID', 'Service']),
+}
 
 
 class Cache:
     """Keep a cache of the managed objects
     """
-    # Theoretically, I could listen for signals and keep a local model of
-    # the properties updated with that.  But that would need an event loop
-    # and (I think) more complextiy
+    # When tracking is enabled, we listen for the ObjectManager and
+    # Properties signals and keep the local model of the properties updated
+    # with the deltas.  That needs an event loop, so it is only turned on
+    # when asked for and a main loop is available.
     #
     # TODO - this is a hacky singleton, investigate python best practices
 
-    def __init__(self, bus):
+    def __init__(self, bus, track=False, async_refresh=False, native=False):
         # TODO: do we care that this hardcodes the destination on what is
         # a generic call?
+        self.bus = bus
         proxy = bus.get_object('org.bluez', '/')
 
         self.manager = dbus.Interface(proxy,
                   dbus_interface="org.freedesktop.DBus.ObjectManager") # noqa
         self.valid = 0
+        self.native = native
+        self.all_objects = {}
+        self._stale = set()
+        self._index_clear()
+
+        # functions to call with (cache, path) when an object goes away
+        self.removed_callbacks = []
+
+        self.stats = {
+            'fetch': 0,             # full GetManagedObjects calls
+            'fetch_avoided': 0,     # invalidations absorbed by tracking
+            'resync': 0,            # full fetches forced by lost signals
+            'added': 0,
+            'removed': 0,
+            'changed': 0,
+            'stale': 0,             # lookups answered from a stale snapshot
+            'path_refresh': 0,      # single objects refetched with GetAll
+            'lookup': 0,            # calls to Get()
+            'block_max': 0.0,       # longest time we have blocked (seconds)
+            'block_total': 0.0,
+        }
+
+        # When async_refresh is enabled, a refetch is done with a reply
+        # handler and callers are given the stale snapshot until it arrives
+        self.async_refresh = False
+        if async_refresh and dbus.get_default_main_loop() is not None:
+            self.async_refresh = True
+        self.refreshing = False
+        self._refresh_callbacks = []
+        self._have_snapshot = False
+
+        # without a main loop, the signals would never be dispatched to us
+        self.tracking = False
+        if track and dbus.get_default_main_loop() is not None:
+            self._track(bus)
+
+    def _track(self, bus):
+        """Subscribe to the signals needed to keep the cache up to date
+        """
+        bus.add_signal_receiver(
+            self._handleInterfacesAdded,
+            signal_name='InterfacesAdded',
+            dbus_interface='org.freedesktop.DBus.ObjectManager',
+            bus_name='org.bluez',
+        )
+        bus.add_signal_receiver(
+            self._handleInterfacesRemoved,
+            signal_name='InterfacesRemoved',
+            dbus_interface='org.freedesktop.DBus.ObjectManager',
+            bus_name='org.bluez',
+        )
+        bus.add_signal_receiver(
+            self._handlePropertiesChanged,
+            signal_name='PropertiesChanged',
+            dbus_interface='org.freedesktop.DBus.Properties',
+            bus_name='org.bluez',
+            path_keyword='path',
+        )
+        # If bluetoothd restarts, we have lost track of everything
+        bus.add_signal_receiver(
+            self._handleNameOwnerChanged,
+            signal_name='NameOwnerChanged',
+            dbus_interface='org.freedesktop.DBus',
+            bus_name='org.freedesktop.DBus',
+            arg0='org.bluez',
+        )
+        self.tracking = True
+
+    def _properties(self, properties):
+        """Convert one interface worth of properties into the form we
+           keep in the cache
+        """
+        if not self.native:
+            return properties
+        return native(properties)
+
+    def _objects(self, objects):
+        """Convert a complete GetManagedObjects result
+        """
+        if not self.native:
+            return objects
+        return {
+            str(path): {
+                str(interface): native(properties)
+                for interface, properties in interfaces.items()
+            }
+            for path, interfaces in objects.items()
+        }
+
+    def _index_clear(self):
+        """Reset the secondary indexes
+        """
+        self._by_interface = {}     # interface -> set(paths)
+        self._by_uuid = {}          # characteristic uuid -> set(paths)
+        self._by_device_uuid = {}   # (device, uuid) -> set(paths)
+        self._device_chars = {}     # device -> set(characteristic paths)
+        self._char_info = {}        # characteristic -> (uuid, service)
+        self._char_device = {}      # characteristic -> device
+        self._service_device = {}   # service -> device
+        self._orphans = {}          # service -> set(characteristic paths)
+
+    def _index_char_device(self, path, device):
+        """Record that the characteristic at path belongs to device
+        """
+        uuid = self._char_info[path][0]
+        self._char_device[path] = device
+        self._device_chars.setdefault(device, set()).add(path)
+        self._by_device_uuid.setdefault((device, uuid), set()).add(path)
+
+    def _index_add(self, path, interfaces):
+        """Add the given interfaces of one object to the indexes
+        """
+        for interface in interfaces:
+            self._by_interface.setdefault(interface, set()).add(path)
+
+        if 'org.bluez.GattService1' in interfaces:
+            service = interfaces['org.bluez.GattService1']
+            device = service.get('Device')
+            if device is not None:
+                self._service_device[path] = device
+                # adopt any characteristics that arrived before us
+                for char in self._orphans.pop(path, ()):
+                    self._index_char_device(char, device)
+
+        if 'org.bluez.GattCharacteristic1' in interfaces:
+            char = interfaces['org.bluez.GattCharacteristic1']
+            uuid = char.get('UUID')
+            service = char.get('Service')
+            self._char_info[path] = (uuid, service)
+            self._by_uuid.setdefault(uuid, set()).add(path)
+            if service in self._service_device:
+                self._index_char_device(path, self._service_device[service])
+            else:
+                self._orphans.setdefault(service, set()).add(path)
+
+    def _index_remove(self, path, interfaces):
+        """Remove the given interface names of one object from the indexes
+        """
+        for interface in interfaces:
+            self._by_interface.get(interface, set()).discard(path)
+
+        if 'org.bluez.GattService1' in interfaces:
+            self._service_device.pop(path, None)
+
+        if 'org.bluez.GattCharacteristic1' in interfaces:
+            uuid, service = self._char_info.pop(path, (None, None))
+            self._by_uuid.get(uuid, set()).discard(path)
+            self._orphans.get(service, set()).discard(path)
+            device = self._char_device.pop(path, None)
+            if device is not None:
+                self._device_chars[device].discard(path)
+                self._by_device_uuid[(device, uuid)].discard(path)
+
+    def _index_rebuild(self):
+        """Build all the indexes from the complete set of objects
+        """
+        self._index_clear()
+        for path, interfaces in self.all_objects.items():
+            self._index_add(path, interfaces)
+
+    def _resync(self):
+        """We have missed some signals, the only fix is a full fetch
+        """
+        if self.valid:
+            self.stats['resync'] += 1
+        self.valid = 0
+
+    def _handleInterfacesAdded(self, path, interfaces):
+        if not self.valid:
+            # the next full fetch will include this
+            return
+        self.stats['added'] += 1
+        path = str(path)
+        if path not in self.all_objects:
+            self.all_objects[path] = {}
+        self._index_remove(path, interfaces)
+        for interface, properties in interfaces.items():
+            properties = self._properties(properties)
+            self.all_objects[path][str(interface)] = properties
+        self._index_add(path, {
+            interface: self.all_objects[path][interface]
+            for interface in interfaces
+        })
+
+    def _handleInterfacesRemoved(self, path, interfaces):
+        if not self.valid:
+            return
+        self.stats['removed'] += 1
+        if path not in self.all_objects:
+            return
+        self._index_remove(path, interfaces)
+        for interface in interfaces:
+            self.all_objects[path].pop(interface, None)
+        if not self.all_objects[path]:
+            del self.all_objects[path]
+            self._removed(path)
+
+    def _handlePropertiesChanged(self, interface, changed, invalidated,
+                                 path=None):
+        if not self.valid:
+            return
+        if path not in self.all_objects or \
+                interface not in self.all_objects[path]:
+            # we have never heard of this object, so we must have missed
+            # the signal that created it
+            self._resync()
+            return
+        self.stats['changed'] += 1
+        properties = self.all_objects[path][interface]
+
+        # This is called for every notify (as a change to the Value), so
+        # only the indexed properties are worth reindexing for
+        indexed = _indexed.get(interface, ())
+        reindex = any(key in indexed for key in changed) or \
+            any(key in indexed for key in invalidated)
+        if reindex:
+            self._index_remove(path, [interface])
+
+        # Update just the changed keys, in place.  The dict methods are used
+        # directly so that this also works for our own FrozenDict - nothing
+        # else gets to change it.
+        for property, value in changed.items():
+            if self.native:
+                property = str(property)
+                value = native(value)
+            dict.__setitem__(properties, property, value)
+        for property in invalidated:
+            dict.pop(properties, property, None)
+
+        if reindex:
+            self._index_add(path, {interface: properties})
+
+    def _handleNameOwnerChanged(self, name, old_owner, new_owner):
+        self._resync()
+
+    def _blocked(self, start):
+        """Account for some time that we have spent blocking the caller
+        """
+        elapsed = time.monotonic() - start
+        self.stats['block_total'] += elapsed
+        if elapsed > self.stats['block_max']:
+            self.stats['block_max'] = elapsed
+
+    def _load(self, objects, start=None):
+        """Install a complete new set of managed objects
+        """
+        if start is None:
+            start = time.monotonic()
+        old = self.all_objects
+        self.all_objects = self._objects(objects)
+        self._stale = set()
+        self.stats['fetch'] += 1
+        self._index_rebuild()
+        self._have_snapshot = True
+        self.valid = 1
+        self._blocked(start)
+
+        if self.removed_callbacks:
+            for path in old:
+                if path not in self.all_objects:
+                    self._removed(path)
+
+    def _removed(self, path):
+        """Tell anyone who is interested that an object has gone away
+        """
+        for callback in self.removed_callbacks:
+            callback(self, path)
+
+    def refresh(self, callback=None):
+        """Start an asynchronous refetch of all the managed objects
+           The callback (if any) is called with this cache and either None
+           or the exception that stopped the refresh
+        """
+        if callback is not None:
+            self._refresh_callbacks.append(callback)
+        if self.refreshing:
+            # just wait for the one already in flight
+            return
+
+        def reply(objects):
+            self.refreshing = False
+            self._load(objects)
+            self._refresh_done(None)
+
+        def error(e):
+            self.refreshing = False
+            self._refresh_done(e)
+
+        self.refreshing = True
+        self.manager.GetManagedObjects(
+            reply_handler=reply,
+            error_handler=error,
+        )
+
+    def _refresh_done(self, exception):
+        callbacks = self._refresh_callbacks
+        self._refresh_callbacks = []
+        for callback in callbacks:
+            callback(self, exception)
 
     def _validate(self):
         """Ensure that the cache is currently valid
            This could be a more complex cache validity system, but right
            now, it can simply throw away the whole cache
         """
+        if self.valid:
+            return
+
+        if self.async_refresh and self._have_snapshot:
+            # Do not stall the main loop, answer from the old data while
+            # the new data is on its way
+            self.stats['stale'] += 1
+            self.refresh()
+            return
+
+        start = time.monotonic()
+        objects = self.manager.GetManagedObjects()
+        self._load(objects, start)
+
+    def _refresh_path(self, path):
+        """Refetch the properties of a single stale object
+        """
+        start = time.monotonic()
+        self._stale.discard(path)
+        self.stats['path_refresh'] += 1
+
+        proxy = self.bus.get_object('org.bluez', path)
+        properties = dbus.Interface(proxy,
+                  dbus_interface="org.freedesktop.DBus.Properties") # noqa
+
+        interfaces = self.all_objects[path]
+        for interface in list(interfaces):
+            if interface.startswith('org.freedesktop.DBus.'):
+                # the standard interfaces have no properties to refresh
+                continue
+            try:
+                new = self._properties(properties.GetAll(interface))
+            except dbus.exceptions.DBusException as e:
+                if e.get_dbus_name() not in (
+                        'org.freedesktop.DBus.Error.UnknownObject',
+                        'org.freedesktop.DBus.Error.UnknownInterface',
+                        'org.freedesktop.DBus.Error.InvalidArgs'):
+                    # no idea what went wrong, start again from scratch
+                    self.valid = 0
+                    self._blocked(start)
+                    return
+                # this interface has gone away
+                self._index_remove(path, [interface])
+                del interfaces[interface]
+                continue
+            self._index_remove(path, [interface])
+            interfaces[interface] = new
+            self._index_add(path, {interface: new})
+
+        if not interfaces:
+            del self.all_objects[path]
+            self._removed(path)
+        self._blocked(start)
+
+    def invalidate(self, path=None):
+        """Mark the cache as needing a refetch.  If a path is given, only
+           the object at that path and all the objects below it are marked
+           as stale and they will be refetched one at a time when used
+        """
+        if self.tracking and self.valid:
+            # the signals are keeping us up to date, no need to refetch
+            self.stats['fetch_avoided'] += 1
+            return
+        if path is None:
+            self.valid = 0
+            return
         if not self.valid:
-            # TODO - ideally, we would detect that we have a main loop
-            # running and use an async call and run the loop while waiting
-            self.all_objects = self.manager.GetManagedObjects()
-            self.valid = 1
+            # everything is going to be refetched anyway
+            return
 
-    def invalidate(self):
-        self.valid = 0
+        prefix = path + '/'
+        for p in self.all_objects:
+            if p == path or p.startswith(prefix):
+                self._stale.add(p)
+
+    def _refresh_stale(self):
+        """Refetch everything that has been marked as stale.  The indexes
+           cover the whole tree, so this is needed before using them
+        """
+        for path in list(self._stale):
+            if not self.valid:
+                break
+            if path in self.all_objects:
+                self._refresh_path(path)
+            else:
+                self._stale.discard(path)
+        # a refresh that went wrong will have asked for a full refetch
+        self._validate()
+
+    def is_stale(self, path):
+        """Will the next lookup for this path need to refetch it?
+        """
+        return not self.valid or path in self._stale
+
+    def stats_snapshot(self):
+        """Return a copy of the counters, along with the hit rate (the
+           fraction of lookups that did not need anything fetched)
+        """
+        snapshot = dict(self.stats)
+        snapshot['hit_rate'] = None
+        if self.stats['lookup']:
+            misses = self.stats['fetch'] + self.stats['path_refresh']
+            snapshot['hit_rate'] = max(
+                0.0, 1.0 - misses / float(self.stats['lookup']))
+        return snapshot
 
     def Get(self, path, interface, property):
+        self.stats['lookup'] += 1
         self._validate()
+        if path in self._stale:
+            self._refresh_path(path)
         if path not in self.all_objects:
             return None
         if interface not in self.all_objects[path]:
@@ -48,8 +497,29 @@ class Cache:
         """Return the set of all paths that have the given interface
         """
         self._validate()
-        result = set()
-        for path, interfaces in self.all_objects.items():
-            if interface in interfaces:
-                result.add(path)
-        return result
+        self._refresh_stale()
+        return set(self._by_interface.get(interface, ()))
+
+    def uuid2paths(self, uuid, device=None):
+        """Return the set of all characteristic paths with the given UUID,
+           optionally only those belonging to the given device
+        """
+        self._validate()
+        self._refresh_stale()
+        if device is None:
+            return set(self._by_uuid.get(uuid, ()))
+        return set(self._by_device_uuid.get((device, uuid), ()))
+
+    def device2characteristics(self, device):
+        """Return the set of all characteristic paths under a device
+        """
+        self._validate()
+        self._refresh_stale()
+        return set(self._device_chars.get(device, ()))
+
+    def characteristic2device(self, path):
+        """Return the device path that owns the given characteristic
+        """
+        self._validate()
+        self._refresh_stale()
+        return self._char_device.get(path)
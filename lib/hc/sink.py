@@ -0,0 +1,212 @@
+import csv
+import io
+import json
+import math
+import struct
+import sys
+import time
+
+
+class Sink:
+    """Somewhere to send the records collected by the tools.
+
+       Each record is a dict with some of the names from fields.  Records
+       are formatted as they arrive, but only written out in batches - when
+       flush_size records are waiting, or when it has been flush_interval
+       seconds since the last write - and then with a single write() call.
+       Something should call tick() every now and then, so that a quiet
+       stream still gets written out.
+
+       Used on its own, this writes the records as space separated text
+       (see TextSink for the full text format).
+    """
+
+    binary = False
+
+    def __init__(self, fields, file=None, flush_interval=1.0, flush_size=64,
+                 formats=None):
+        if file is None:
+            file = sys.stdout
+        self.fields = fields
+        self.file = file
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.formats = formats or {}
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self.stats = {
+            'records': 0,
+            'writes': 0,
+        }
+        self._start()
+
+    def _start(self):
+        """Output anything needed at the start of the stream
+        """
+        pass
+
+    def _format(self, record):
+        return ' '.join(
+            self._format_value(name, record[name])
+            for name in self.fields if name in record
+        ) + '\n'
+
+    def _format_value(self, name, value):
+        if value is None:
+            return "\\N"
+        return self.formats.get(name, "{}").format(value)
+
+    def write(self, record):
+        self.stats['records'] += 1
+        self._pending.append(self._format(record))
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+        else:
+            self.tick()
+
+    def comment(self, text):
+        """Output a human readable comment.  Only the text format can hold
+           these, so the other formats send them to stderr instead
+        """
+        print(text, file=sys.stderr)
+
+    def gap(self, count=1):
+        """Mark a break in the data (gnuplot stops drawing the line)
+        """
+        pass
+
+    def tick(self):
+        """Write out anything that has been waiting too long.  Returns True,
+           so this can be used directly as a GLib timeout
+        """
+        if self._pending:
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+        return True
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        if self.binary:
+            data = b''.join(self._pending)
+            out = self.file.buffer
+            # anything already in the text layer needs to go first
+            self.file.flush()
+        else:
+            data = ''.join(self._pending)
+            out = self.file
+        self._pending = []
+        out.write(data)
+        out.flush()
+        self.stats['writes'] += 1
+
+    def close(self):
+        self.flush()
+
+
+class TextSink(Sink):
+    """The original output format - space separated columns that gnuplot
+       can read, with "\\N" for missing values and "#" comments.  Only the
+       fields present in each record are output.  The comments and gaps
+       are kept in the stream, in order with the records.
+    """
+
+    def comment(self, text):
+        # in with the data, so that it stays in order
+        self._pending.append(text + '\n')
+        self.tick()
+
+    def gap(self, count=1):
+        self._pending.append('\n' * count)
+
+
+class CsvSink(Sink):
+    """Comma separated values, with a header row of the field names
+    """
+
+    def _start(self):
+        self._buf = io.StringIO()
+        self._csv = csv.writer(self._buf, lineterminator='\n')
+        self._pending.append(self._row(self.fields))
+
+    def _row(self, values):
+        self._csv.writerow(values)
+        row = self._buf.getvalue()
+        self._buf.seek(0)
+        self._buf.truncate()
+        return row
+
+    def _format(self, record):
+        return self._row([record.get(name) for name in self.fields])
+
+
+class JsonLinesSink(Sink):
+    """One JSON object per line.  JSON has no NaN or infinity (eg, for an
+       OWON overload), so those are written as null
+    """
+
+    def _format(self, record):
+        return json.dumps({
+            name: None if isinstance(value, float) and not math.isfinite(value)
+            else value
+            for name, value in record.items()
+        }) + '\n'
+
+
+class BinarySink(Sink):
+    """Packed binary records, for when there is a lot of data.
+
+       The stream starts with a line of magic and a line of JSON describing
+       the fields.  After that, each chunk starts with a type byte:
+        R - a record, one little endian double per field (NaN if missing),
+            except that strings are given as a uint16 id
+        N - a new string id: uint16 id, uint16 length, then utf8 bytes
+    """
+
+    binary = True
+    magic = b'HCSINK1\n'
+
+    def _start(self):
+        self._ids = {}
+        self._record = struct.Struct('<' + 'd' * len(self.fields))
+        self._name = struct.Struct('<HH')
+        header = json.dumps({'fields': self.fields, 'format': '<d'})
+        self._pending.append(self.magic + header.encode() + b'\n')
+
+    def _string_id(self, value):
+        """Return the id for a string, sending its definition first if it
+           is new
+        """
+        id = self._ids.get(value)
+        if id is None:
+            id = len(self._ids)
+            self._ids[value] = id
+            data = value.encode()
+            self._pending.append(b'N' + self._name.pack(id, len(data)) + data)
+        return id
+
+    def _format(self, record):
+        values = []
+        for name in self.fields:
+            value = record.get(name)
+            if value is None:
+                value = math.nan
+            elif isinstance(value, str):
+                value = self._string_id(value)
+            values.append(value)
+        return b'R' + self._record.pack(*values)
+
+
+kinds = {
+    'text': TextSink,
+    'csv': CsvSink,
+    'json': JsonLinesSink,
+    'binary': BinarySink,
+}
+
+
+def open_sink(kind, fields, **kwargs):
+    """Create a sink of the named kind (one of the keys of kinds)
+    """
+    return kinds[kind](fields, **kwargs)
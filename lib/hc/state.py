@@ -0,0 +1,41 @@
+import json
+import os
+
+
+class StateFile:
+    """A small JSON file holding a dict of settings for each device, keyed by
+       the device address.  This is used to remember things between runs of
+       the tools.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+
+    def save(self):
+        """Write the state out, replacing the old file in one step so that a
+           crash never leaves a half written file behind
+        """
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+            f.write('\n')
+        os.replace(tmp, self.filename)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def update(self, key, **values):
+        """Merge the given values into the entry for key
+        """
+        entry = self.data.setdefault(key, {})
+        entry.update(values)
+        return entry
@@ -0,0 +1,99 @@
+import time
+
+
+class Histogram:
+    """Keep a count of how long something takes, in power of two buckets of
+       microseconds.  This is cheap enough to use on every call.
+    """
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # bucket n holds the times from 2**(n-1) up to 2**n microseconds
+        self.buckets = [0] * 32
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        bucket = min(int(seconds * 1000000).bit_length(), 31)
+        self.buckets[bucket] += 1
+
+    def percentile(self, percent):
+        """Return the upper bound (in seconds) of the bucket that holds the
+           given percentile
+        """
+        if not self.count:
+            return None
+        want = self.count * percent / 100.0
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= want:
+                return min((1 << bucket) / 1000000.0, self.max)
+        return self.max
+
+    def snapshot(self):
+        mean = None
+        if self.count:
+            mean = self.total / self.count
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'mean': mean,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Rate:
+    """Count events and work out how often they happen
+    """
+    __slots__ = ('count', 'first', 'last')
+
+    def __init__(self):
+        self.count = 0
+        self.first = None
+        self.last = None
+
+    def add(self):
+        now = time.monotonic()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += 1
+
+    def snapshot(self):
+        rate = None
+        if self.count > 1 and self.last > self.first:
+            rate = (self.count - 1) / (self.last - self.first)
+        return {
+            'count': self.count,
+            'per_second': rate,
+        }
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    return "{:.3f}ms".format(seconds * 1000)
+
+
+def format_histogram(snapshot):
+    """Return a short one line summary of a Histogram snapshot
+    """
+    return "n={} mean={} p50<={} p99<={} max={}".format(
+        snapshot['count'],
+        format_seconds(snapshot['mean']),
+        format_seconds(snapshot['p50']),
+        format_seconds(snapshot['p99']),
+        format_seconds(snapshot['max']),
+    )
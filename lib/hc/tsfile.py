@@ -0,0 +1,373 @@
+# A compact, append-only file of temperature and humidity readings.
+#
+# The file starts with a fixed size header region:
+#     0       the header (see HEADER)
+#     64      a JSON list of the device names, indexed by the device id (a
+#             new name that does not fit before the index is refused)
+#     4096    the block index - the min and max timestamp of each block of
+#             block_size records
+#     65536   the records (see RECORD), in the order they were appended
+#
+# The block index never grows past the header region - when it fills up,
+# neighbouring blocks are merged and block_size doubles.  If the records
+# were all appended in time order, the sorted flag is set and the reader
+# can binary search the records directly, otherwise it uses the block
+# index to skip over the parts of the file that cannot match.  Either way,
+# the records are read back in time order.
+
+import heapq
+import itertools
+import json
+import math
+import mmap
+import struct
+import time
+
+MAGIC = b'HCTS'
+VERSION = 1
+
+# magic, version, record size, flags, count, block_size, nblocks,
+# names length, min timestamp, max timestamp
+HEADER = struct.Struct('<4sHHHQIII2d')
+NAMES_OFFSET = 64
+INDEX_OFFSET = 4096
+INDEX_ENTRY = struct.Struct('<dd')
+DATA_OFFSET = 65536
+MAX_BLOCKS = (DATA_OFFSET - INDEX_OFFSET) // INDEX_ENTRY.size
+
+# timestamp, device id, temperature, humidity, flags
+RECORD = struct.Struct('<dHffB')
+
+# bits in the flags header field
+SORTED = 1
+
+# bits in the record flags
+TEMPERATURE = 1
+HUMIDITY = 2
+
+
+def pack_names(names):
+    """Return the JSON for the device names, checking that it fits
+    """
+    packed = json.dumps(names).encode()
+    if NAMES_OFFSET + len(packed) > INDEX_OFFSET:
+        raise ValueError("Too many device names for the header")
+    return packed
+
+
+class Header:
+    """Everything in the header region, decoded
+    """
+
+    def __init__(self, block_size=1024):
+        self.flags = SORTED
+        self.count = 0
+        self.block_size = block_size
+        self.names = []
+        self.index = []
+        self.min = math.nan
+        self.max = math.nan
+
+    @classmethod
+    def unpack(cls, buf):
+        (magic, version, record_size, flags, count, block_size, nblocks,
+         names_len, min_ts, max_ts) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a time series file")
+        if version != VERSION or record_size != RECORD.size:
+            raise ValueError("Unknown time series file version")
+
+        self = cls(block_size)
+        self.flags = flags
+        self.count = count
+        self.min = min_ts
+        self.max = max_ts
+        names = bytes(buf[NAMES_OFFSET:NAMES_OFFSET + names_len])
+        self.names = json.loads(names.decode()) if names_len else []
+        self.index = [
+            list(INDEX_ENTRY.unpack_from(buf, INDEX_OFFSET + n * INDEX_ENTRY.size))
+            for n in range(nblocks)
+        ]
+        return self
+
+    def pack(self):
+        """Return the header and names, ready to write at offset 0
+        """
+        names = pack_names(self.names)
+        header = HEADER.pack(
+            MAGIC, VERSION, RECORD.size, self.flags, self.count,
+            self.block_size, len(self.index), len(names), self.min, self.max,
+        )
+        return header + bytes(NAMES_OFFSET - len(header)) + names
+
+    def pack_index(self, first=0):
+        return b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index[first:])
+
+    @property
+    def sorted(self):
+        return bool(self.flags & SORTED)
+
+
+class Writer:
+    """Append readings to a time series file, creating it if needed.
+
+       Like hc.sink.Sink, the records are buffered and written in batches:
+       when flush_size are waiting or when tick() is called more than
+       flush_interval seconds after the last write.  The header is only
+       updated after the records it counts are written, so an interrupted
+       write loses the last batch rather than leaving garbage records.
+    """
+
+    def __init__(self, filename, flush_interval=1.0, flush_size=256,
+                 block_size=1024):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+
+        try:
+            self.file = open(filename, 'r+b')
+            self.header = Header.unpack(self.file.read(DATA_OFFSET))
+        except FileNotFoundError:
+            self.file = open(filename, 'w+b')
+            self.header = Header(block_size)
+            self.file.write(self.header.pack())
+            self.file.truncate(DATA_OFFSET)
+
+        self._ids = {name: id for id, name in enumerate(self.header.names)}
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def device_id(self, name):
+        id = self._ids.get(name)
+        if id is None:
+            # check now, as once the records are buffered it is too late to
+            # refuse them
+            pack_names(self.header.names + [name])
+            id = len(self.header.names)
+            self.header.names.append(name)
+            self._ids[name] = id
+        return id
+
+    def append(self, timestamp, device, temperature=None, humidity=None):
+        flags = 0
+        if temperature is None:
+            temperature = math.nan
+        else:
+            flags |= TEMPERATURE
+        if humidity is None:
+            humidity = math.nan
+        else:
+            flags |= HUMIDITY
+
+        self._pending.append((timestamp, RECORD.pack(
+            timestamp, self.device_id(device), temperature, humidity, flags,
+        )))
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def tick(self):
+        """Write out anything that has been waiting too long.  Returns True,
+           so this can be used directly as a GLib timeout
+        """
+        if self._pending:
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+        return True
+
+    def _index(self, n, timestamp):
+        """Add the record number n to the block index
+        """
+        header = self.header
+        block = n // header.block_size
+        if block < len(header.index):
+            entry = header.index[block]
+            if timestamp < entry[0]:
+                entry[0] = timestamp
+            if timestamp > entry[1]:
+                entry[1] = timestamp
+            return False
+
+        if block == MAX_BLOCKS:
+            # out of room, so merge each pair of blocks
+            index = header.index
+            header.index = [
+                [min(index[i][0], index[i + 1][0]),
+                 max(index[i][1], index[i + 1][1])]
+                for i in range(0, len(index), 2)
+            ]
+            header.block_size *= 2
+            self._index(n, timestamp)
+            return True
+
+        header.index.append([timestamp, timestamp])
+        return False
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+
+        header = self.header
+        self.file.seek(DATA_OFFSET + header.count * RECORD.size)
+        self.file.write(b''.join(record for timestamp, record in self._pending))
+
+        first_block = header.count // header.block_size
+        merged = False
+        for timestamp, record in self._pending:
+            if header.count and timestamp < header.max:
+                header.flags &= ~SORTED
+            if not header.count or timestamp > header.max:
+                header.max = timestamp
+            if not header.count or timestamp < header.min:
+                header.min = timestamp
+            merged |= self._index(header.count, timestamp)
+            header.count += 1
+        self._pending = []
+
+        # make sure the records are written before the header counts them
+        self.file.flush()
+
+        if merged:
+            first_block = 0
+        self.file.seek(INDEX_OFFSET + first_block * INDEX_ENTRY.size)
+        self.file.write(header.pack_index(first_block))
+        self.file.seek(0)
+        self.file.write(header.pack())
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class Reader:
+    """Read a time series file through mmap, so only the pages that are
+       actually needed are read from the disk
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = Header.unpack(self.map)
+        self.names = self.header.names
+        self.count = self.header.count
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def timestamp(self, n):
+        return struct.unpack_from('<d', self.map, DATA_OFFSET + n * RECORD.size)[0]
+
+    def _bisect(self, timestamp, lo, hi, right=False):
+        """Find the record number of the first record at (or after, if
+           right is set) timestamp, within [lo, hi).  The records must be
+           sorted
+        """
+        while lo < hi:
+            mid = (lo + hi) // 2
+            this = self.timestamp(mid)
+            if this < timestamp or (right and this == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _spans(self, start, end):
+        """Return the (first, last) record number ranges that could hold
+           records between start and end
+        """
+        header = self.header
+        if header.sorted:
+            lo = 0
+            hi = self.count
+            if start is not None:
+                lo = self._bisect(start, lo, hi)
+            if end is not None:
+                hi = self._bisect(end, lo, hi, right=True)
+            return [(lo, hi)]
+
+        spans = []
+        for block, (min_ts, max_ts) in enumerate(header.index):
+            if start is not None and max_ts < start:
+                continue
+            if end is not None and min_ts > end:
+                continue
+            first = block * header.block_size
+            last = first + header.block_size
+            if spans and spans[-1][1] == first:
+                spans[-1] = (spans[-1][0], last)
+            else:
+                spans.append((first, last))
+        return [(first, min(last, self.count)) for first, last in spans]
+
+    def _records(self, first, last, start, end, device_id):
+        """Yield (timestamp, record number, device id, temperature,
+           humidity) for the matching records in [first, last)
+        """
+        buf = self.map[DATA_OFFSET + first * RECORD.size:
+                       DATA_OFFSET + last * RECORD.size]
+        records = RECORD.iter_unpack(buf)
+        for n, (timestamp, id, temperature, humidity, flags) in \
+                enumerate(records, first):
+            if device_id is not None and id != device_id:
+                continue
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                continue
+            if not flags & TEMPERATURE:
+                temperature = None
+            if not flags & HUMIDITY:
+                humidity = None
+            yield timestamp, n, id, temperature, humidity
+
+    def range(self, start=None, end=None, device=None):
+        """Yield (timestamp, device name, temperature, humidity) for each
+           record between start and end (inclusive, either can be None), in
+           time order.  Missing values are given as None.
+
+           A device can have several records with the same timestamp (eg,
+           when the same history was appended on two runs), these are
+           merged into one.
+        """
+        device_id = None
+        if device is not None:
+            if device not in self.names:
+                return
+            device_id = self.names.index(device)
+
+        spans = [
+            self._records(first, last, start, end, device_id)
+            for first, last in self._spans(start, end)
+            if first < last
+        ]
+        if self.header.sorted:
+            records = itertools.chain.from_iterable(spans)
+        else:
+            # sort the matching records in each span, then merge them
+            records = heapq.merge(*[sorted(span) for span in spans])
+
+        # gather up everything with the same timestamp, for merging
+        group_timestamp = None
+        group = {}
+        for timestamp, n, id, temperature, humidity in records:
+            if timestamp != group_timestamp:
+                yield from self._group(group_timestamp, group)
+                group_timestamp = timestamp
+                group = {}
+            values = group.get(id)
+            if values is None:
+                group[id] = [temperature, humidity]
+                continue
+            if values[0] is None:
+                values[0] = temperature
+            if values[1] is None:
+                values[1] = humidity
+        yield from self._group(group_timestamp, group)
+
+    def _group(self, timestamp, group):
+        for id, (temperature, humidity) in group.items():
+            yield timestamp, self.names[id], temperature, humidity